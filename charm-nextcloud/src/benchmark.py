@@ -0,0 +1,124 @@
+"""WebDAV throughput benchmark against the local nextcloud."""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('put', 'get', 'propfind')
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+PROPFIND_BODY = ('<?xml version="1.0"?>'
+                 '<d:propfind xmlns:d="DAV:"><d:prop>'
+                 '<d:getlastmodified/><d:getcontentlength/><d:getetag/>'
+                 '</d:prop></d:propfind>')
+
+
+def parse_size(size) -> int:
+    """
+    Parse a size like 4K, 1M or 512 into bytes.
+    """
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    return int(size[:len(size) - len(unit)]) * SIZE_UNITS[unit]
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of samples, None when there are none.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(latencies, errors, elapsed, nbytes=0) -> dict:
+    """
+    Summarize one workload: latencies in seconds of the successful
+    requests, count of failed ones, wall clock seconds, bytes moved.
+    """
+    total = len(latencies) + errors
+    summary = {
+        'requests': total,
+        'errors': errors,
+        'error-rate': round(errors / total, 4) if total else 0.0,
+        'ops-per-sec': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+    }
+    if nbytes:
+        summary['mib-per-sec'] = round(nbytes / elapsed / 1024 ** 2, 2) if elapsed else 0.0
+    if latencies:
+        for pct in (50, 95, 99):
+            summary['p{}-ms'.format(pct)] = round(percentile(latencies, pct) * 1000, 2)
+    return summary
+
+
+class WebdavBenchmark:
+    """
+    Runs concurrent PUT/GET/PROPFIND workloads against the WebDAV
+    endpoint of a nextcloud user, one round per file size.
+    """
+
+    def __init__(self, base_url, user, password, concurrency=4, session_factory=None):
+        self._url = '{}/remote.php/dav/files/{}/'.format(base_url.rstrip('/'), user)
+        self._auth = (user, password)
+        self._concurrency = concurrency
+        if session_factory is None:
+            import requests
+            session_factory = requests.Session
+        self._session_factory = session_factory
+        self._local = threading.local()
+
+    def _session(self):
+        # Sessions keep connections alive but are not thread safe,
+        # so every worker thread gets its own.
+        if not hasattr(self._local, 'session'):
+            self._local.session = self._session_factory()
+            self._local.session.auth = self._auth
+        return self._local.session
+
+    def _request(self, method, name, **kwargs):
+        started = time.monotonic()
+        try:
+            response = self._session().request(method, self._url + name, **kwargs)
+            ok = response.status_code < 400
+        except Exception as e:
+            logger.debug("benchmark %s %s failed: %s", method, name, e)
+            ok = False
+        return ok, time.monotonic() - started
+
+    def _workload(self, method, names, nbytes_each=0, **kwargs) -> dict:
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self._concurrency) as pool:
+            outcomes = list(pool.map(lambda n: self._request(method, n, **kwargs), names))
+        elapsed = time.monotonic() - started
+        latencies = [latency for ok, latency in outcomes if ok]
+        errors = len(outcomes) - len(latencies)
+        return summarize(latencies, errors, elapsed, nbytes_each * len(latencies))
+
+    def run(self, sizes, files, operations=OPERATIONS) -> dict:
+        """
+        Benchmark each size with the given number of files.
+        Files are always uploaded, since GET and PROPFIND need them,
+        but PUT is only reported when asked for. Files are deleted afterwards.
+        """
+        results = {}
+        for size in sizes:
+            nbytes = parse_size(size)
+            label = size.strip().lower()
+            payload = os.urandom(nbytes)
+            names = ['benchmark-{}-{}'.format(label, i) for i in range(files)]
+            put = self._workload('PUT', names, nbytes, data=payload)
+            if 'put' in operations:
+                results['put-' + label] = put
+            if 'get' in operations:
+                results['get-' + label] = self._workload('GET', names, nbytes)
+            if 'propfind' in operations:
+                results['propfind-' + label] = self._workload(
+                    'PROPFIND', names, headers={'Depth': '0'}, data=PROPFIND_BODY)
+            self._workload('DELETE', names)
+        return results
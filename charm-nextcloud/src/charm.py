@@ -6,15 +6,15 @@ import logging
 import subprocess
 import sys
 import os
+import shutil
 import socket
+import time
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
 import json
 
 from ops.charm import CharmBase
 from ops.main import main
 from ops.framework import StoredState
-from ops.lib import use
 from io import BytesIO
 
 
@@ -25,19 +25,77 @@ from ops.model import (
 )
 
 
-from utils import open_port
+from utils import (open_port, php_size_to_bytes, mem_total_bytes, max_php_workers,
+                   TimedProcess)
 from occ import Occ
+from paths import NextcloudPaths, DEFAULT_ROOT
 from interface_http import HttpProvider
-import interface_redis
 
 logger = logging.getLogger(__name__)
 
-# POSTGRESQL interface documentation
-# https://github.com/canonical/ops-lib-pgsql
-pgsql = use("pgsql", 1, "postgresql-charmers@lists.launchpad.net")
+PACKAGES = ['apache2',
+            'libapache2-mod-php7.2',
+            'php7.2-gd',
+            'php7.2-json',
+            'php7.2-mysql',
+            'php7.2-pgsql',
+            'php7.2-curl',
+            'php7.2-mbstring',
+            'php7.2-intl',
+            'php-imagick',
+            'php7.2-zip',
+            'php7.2-xml',
+            'php-apcu',
+            'php-redis',
+            'php-smbclient',
+            'postgresql-client']
 
-NEXTCLOUD_ROOT = os.path.abspath('/var/www/nextcloud')
-NEXTCLOUD_CONFIG_PHP = os.path.abspath('/var/www/nextcloud/config/config.php')
+# Hooks observed by the pgsql and redis relation clients. The clients,
+# and the libraries behind them, are only loaded when dispatching one
+# of these, keeping frequent hooks such as update-status cheap.
+PGSQL_HOOKS = ('db-relation-', 'upgrade-charm', 'leader-elected', 'leader-settings-changed')
+REDIS_HOOKS = ('redis-relation-',)
+# The pgsql client defers events itself, which can only be re-emitted
+# in later hooks if the client observing them is there again.
+PGSQL_OBSERVER = 'PostgreSQLClient[db]'
+
+# Valid values for nextcloud's log_type.
+LOG_TYPES = ('file', 'syslog', 'systemd', 'errorlog')
+
+# The vhost logs here rather than directly in /var/log/apache2, which the
+# apache2 package already rotates, so our own logrotate policy applies.
+APACHE_LOG_DIR = '/var/log/apache2/nextcloud'
+
+# Shared memory php takes once, whatever the number of workers,
+# rendered into nextcloud.ini and counted in the memory budget.
+OPCACHE_MEMORY_MB = 128
+OPCACHE_INTERNED_STRINGS_MB = 8
+APCU_SHM_MB = 32
+
+
+def dispatched_hook():
+    """
+    Name of the hook or action being dispatched, None outside of Juju
+    (e.g. in the Harness) where everything is loaded.
+    """
+    if 'JUJU_UNIT_NAME' not in os.environ:
+        return None
+    return os.path.basename(os.environ.get('JUJU_DISPATCH_PATH') or sys.argv[0])
+
+
+def hook_needs(prefixes) -> bool:
+    hook = dispatched_hook()
+    return hook is None or hook.startswith(prefixes)
+
+
+def pgsql():
+    """
+    Load the pgsql library on first use.
+    POSTGRESQL interface documentation
+    https://github.com/canonical/ops-lib-pgsql
+    """
+    from ops.lib import use
+    return use("pgsql", 1, "postgresql-charmers@lists.launchpad.net")
 
 
 class NextcloudCharm(CharmBase):
@@ -45,24 +103,31 @@ class NextcloudCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self.db = pgsql.PostgreSQLClient(self, 'db')  # 'db' relation in metadata.yaml
+        self.db = None
+        if hook_needs(PGSQL_HOOKS) or self._pgsql_events_pending():
+            self.db = pgsql().PostgreSQLClient(self, 'db')  # 'db' relation in metadata.yaml
         # The website provider takes care of incoming relations on the http interface.
         self.website = HttpProvider(self, 'website', socket.getfqdn(), 80)
-        self._stored.set_default(data_dir='/var/www/nextcloud/data/',
+        self._stored.set_default(nextcloud_root=DEFAULT_ROOT,
+                                 data_dir=os.path.join(DEFAULT_ROOT, 'data'),
+                                 path_error=None,
+                                 memory_error=None,
                                  nextcloud_fetched=False,
                                  nextcloud_initialized=False,
                                  database_available=False,
                                  apache_configured=False,
-                                 php_configured=False)
+                                 php_configured=False,
+                                 port_opened=False)
         self._stored.set_default(db_conn_str=None, db_uri=None, db_ro_uris=[])
+        # Inputs each reconcile step was last applied with, see _reconcile.
+        self._stored.set_default(applied=dict())
 
         event_bindings = {
             self.on.install: self._on_install,
             self.on.config_changed: self._on_config_changed,
+            self.on.upgrade_charm: self._on_upgrade_charm,
             self.on.start: self._on_start,
             self.on.leader_elected: self._on_leader_elected,
-            self.db.on.database_relation_joined: self._on_database_relation_joined,
-            self.db.on.master_changed: self._on_master_changed,
             self.on.update_status: self._on_update_status,
             self.on.cluster_relation_changed: self._on_cluster_relation_changed,
             self.on.cluster_relation_joined: self._on_cluster_relation_joined,
@@ -70,10 +135,18 @@ class NextcloudCharm(CharmBase):
             self.on.cluster_relation_broken: self._on_cluster_relation_broken
         }
 
+        if self.db is not None:
+            event_bindings[self.db.on.database_relation_joined] = \
+                self._on_database_relation_joined
+            event_bindings[self.db.on.master_changed] = self._on_master_changed
+
         # REDIS
         self._stored.set_default(redis_info=dict())
-        self._redis = interface_redis.RedisClient(self, "redis")
-        self.framework.observe(self._redis.on.redis_available, self._on_redis_available)
+        self._redis = None
+        if hook_needs(REDIS_HOOKS):
+            import interface_redis
+            self._redis = interface_redis.RedisClient(self, "redis")
+            event_bindings[self._redis.on.redis_available] = self._on_redis_available
 
         for event, handler in event_bindings.items():
             self.framework.observe(event, handler)
@@ -81,96 +154,139 @@ class NextcloudCharm(CharmBase):
         action_bindings = {
             self.on.add_missing_indices_action: self._on_add_missing_indices_action,
             self.on.convert_filecache_bigint_action: self._on_convert_filecache_bigint_action,
-            self.on.maintenance_action: self._on_maintenance_action
+            self.on.maintenance_action: self._on_maintenance_action,
+            self.on.benchmark_action: self._on_benchmark_action,
+            self.on.db_optimize_action: self._on_db_optimize_action
         }
 
         for action, handler in action_bindings.items():
             self.framework.observe(action, handler)
 
+    def _pgsql_events_pending(self) -> bool:
+        """
+        True if deferred events are stored for, or by, the pgsql client.
+        """
+        return any(PGSQL_OBSERVER in event_path or PGSQL_OBSERVER in observer_path
+                   for event_path, observer_path, _ in self.framework._storage.notices())
+
     def _on_install(self, event):
-        self._install_deps()
-        if not self._stored.nextcloud_fetched:
-            # Fetch nextcloud to /var/www/
-            self._fetch_and_extract_nextcloud()
+        """
+        Installs the dependencies and fetches the nextcloud sources.
+        The apt transaction runs in the background while the sources
+        are downloaded and extracted, since neither depends on the other.
+        """
+        started = time.monotonic()
+        apt = self._install_deps()
+        try:
+            if not self._stored.nextcloud_fetched:
+                # Nothing to migrate yet, install straight where the config wants it.
+                wanted = self._wanted_paths()
+                self._stored.nextcloud_root = wanted.root
+                self._stored.data_dir = wanted.data_dir
+                self._fetch_and_extract_nextcloud(apt)
+        finally:
+            # Even when fetching failed, or the retried hook would
+            # start another apt against the dpkg lock held by this one.
+            if apt:
+                if apt.running():
+                    self.unit.status = MaintenanceStatus("Sources installed, waiting for apt...")
+                self._wait_for_deps(apt)
+        logger.info("Install hook completed in %.1fs", time.monotonic() - started)
 
     def _on_config_changed(self, event):
         """
-        Any configuration change trigger a complete reconfigure of
-        the php and apache and also a restart of apache.
+        Configuration changes are applied by the reconcile loop,
+        which only reconfigures (and restarts) what the change touched.
         :param event:
         :return:
         """
-        self._config_apache2()
-        self._config_php()
-        # self._config_website()
-        subprocess.check_call(['systemctl', 'restart', 'apache2.service'])
-        self._on_update_status(event)
+        self._reconcile()
 
-    def _on_database_relation_joined(self, event: pgsql.DatabaseRelationJoinedEvent):
+    def _on_upgrade_charm(self, event):
+        """
+        Templates may have changed with the charm, so forget
+        what has been applied and let reconcile render everything again.
+        """
+        self._stored.applied = dict()
+        self._reconcile()
+
+    def _on_database_relation_joined(self, event):
         if self.model.unit.is_leader():
             # Provide requirements to the PostgreSQL server.
             event.database = 'nextcloud'  # Request database named mydbname
             event.extensions = ['citext']  # Request the citext extension installed
-        elif event.database != 'nextcloud':
-            # Leader has not yet set requirements. Defer, incase this unit
-            # becomes leader and needs to perform that operation.
-            event.defer()
-            return
+        # The client emits this once per relation and unit, so when no leader
+        # handled it, the next leader sets the requirements in _reconcile_leader.
 
-    # Only leader is running this hook (verify this)
     def _on_leader_elected(self, event):
         logger.debug("!!!!!!!!new leader!!!!!!!!")
         self.framework.breakpoint('leader')
-        self.update_config_php_trusted_domains()
+        self._reconcile()
 
-    def update_config_php_trusted_domains(self):
-        if not os.path.exists(NEXTCLOUD_CONFIG_PHP):
+    @property
+    def paths(self) -> NextcloudPaths:
+        """
+        Where nextcloud currently is, which only differs from
+        _wanted_paths until reconcile has migrated it.
+        """
+        return NextcloudPaths(self._stored.nextcloud_root, self._stored.data_dir,
+                              self.config.get('temp-dir'))
+
+    def _wanted_paths(self) -> NextcloudPaths:
+        return NextcloudPaths(self.config.get('nextcloud-root') or DEFAULT_ROOT,
+                              self.config.get('data-dir'),
+                              self.config.get('temp-dir'))
+
+    @property
+    def occ(self) -> Occ:
+        return Occ(self.paths.root)
+
+    def update_config_php_trusted_domains(self, peer_ips):
+        if not os.path.exists(self.paths.config_php):
             return
         self.framework.breakpoint('trusted')
-        cluster_rel = self.model.relations['cluster'][0]
-        rel_unit_ip = [cluster_rel.data[u]['ingress-address'] for u in cluster_rel.units]
-        this_unit_ip = cluster_rel.data[self.model.unit]['ingress-address']
-        rel_unit_ip.append(this_unit_ip)
-        Occ.update_trusted_domains_peer_ips(rel_unit_ip)
-        with open(NEXTCLOUD_CONFIG_PHP) as f:
+        self.occ.update_trusted_domains_peer_ips(peer_ips)
+        self._publish_config_php()
+
+    def _publish_config_php(self):
+        """
+        Hand the leader's config.php to the followers.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if cluster_rel is None:
+            return
+        with open(self.paths.config_php) as f:
             nextcloud_config = f.read()
             cluster_rel.data[self.app]['nextcloud_config'] = str(nextcloud_config)
 
+    def _peer_ips(self) -> list:
+        """
+        Ingress addresses of all units in the cluster, this unit included.
+        Sorted, since the relation units are a set whose order changes
+        from one hook to the next, and reconcile compares this list.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if cluster_rel is None:
+            return []
+        rel_unit_ip = [cluster_rel.data[u].get('ingress-address') for u in cluster_rel.units]
+        rel_unit_ip.append(cluster_rel.data[self.model.unit].get('ingress-address'))
+        return sorted(ip for ip in rel_unit_ip if ip)
+
     def _on_cluster_relation_joined(self, event):
-        if self.model.unit.is_leader():
-            if not self._stored.nextcloud_initialized:
-                event.defer()
-                return
-            self.framework.breakpoint('joined')
-            self.update_config_php_trusted_domains()
+        self.framework.breakpoint('joined')
+        self._reconcile()
 
     def _on_cluster_relation_changed(self, event):
-        if not self.model.unit.is_leader():
-            if 'nextcloud_config' not in event.relation.data[self.app]:
-                event.defer()
-                return
-            nextcloud_config = nextcloud_config = event.relation.data[self.app]['nextcloud_config']
-            with open(NEXTCLOUD_CONFIG_PHP, "w") as f:
-                f.write(nextcloud_config)
-            data_dir_path = os.path.join(NEXTCLOUD_ROOT, 'data')
-            ocdata_path = os.path.join(data_dir_path, '.ocdata')
-            if not os.path.exists(data_dir_path):
-                os.mkdir(data_dir_path)
-            if not os.path.exists(ocdata_path):
-                open(ocdata_path, 'a').close()
-            self._set_directory_permissions()
-            self._stored.database_available = True
-            self._stored.nextcloud_initialized = True
+        self._reconcile()
 
     def _on_cluster_relation_departed(self, event):
         self.framework.breakpoint('departed')
-        if self.model.unit.is_leader():
-            self.update_config_php_trusted_domains()
+        self._reconcile()
 
     def _on_cluster_relation_broken(self, event):
         pass
 
-    def _on_master_changed(self, event: pgsql.MasterChangedEvent):
+    def _on_master_changed(self, event):
         if event.database != 'nextcloud':
             # Leader has not yet set requirements. Wait until next event,
             # or risk connecting to an incorrect database.
@@ -197,32 +313,227 @@ class NextcloudCharm(CharmBase):
 
         if event.master and event.database == 'nextcloud':
             self._stored.database_available = True
-            if not self._stored.nextcloud_initialized:
-                self._set_directory_permissions()
-                self._init_nextcloud()
-                self._add_initial_trusted_domain()
-                installed = self.get_nextcloud_status()['installed']
-                if installed:
-                    logger.debug("===== Nextcloud install_status: {}====".format(installed))
-                    self._stored.nextcloud_initialized = True
+        self._reconcile()
 
     def _on_start(self, event):
-        if not self._stored.nextcloud_initialized:
-            event.defer()
+        self._reconcile()
+
+    # RECONCILE
+
+    def _reconcile(self):
+        """
+        Bring the unit to the state described by _stored, config and relations.
+        Every handler calls this instead of deferring its event when something
+        is not ready yet. Each step records the inputs it was applied with,
+        and is skipped while those inputs are unchanged, so calling this from
+        frequent hooks such as update-status is cheap.
+        """
+        if not self._stored.nextcloud_fetched:
+            self._update_status()
             return
-        try:
-            subprocess.check_call(['systemctl', 'restart', 'apache2.service'])
-            self._on_update_status(event)
+
+        # Leave apache and php as they are while their config can't fit in memory.
+        budget = self._memory_budget()
+        self._stored.memory_error = budget['error']
+        # Moving stops apache, which is only reconfigured and restarted on
+        # the new paths within budget, so paths wait for it too.
+        if not budget['error'] and not self._reconcile_paths():
+            self._update_status()
+            return
+
+        restart_apache = False
+        if not budget['error'] and self._inputs_changed('apache', self._apache_context()):
+            self._config_apache2()
+            self._mark_applied('apache', self._apache_context())
+            restart_apache = True
+
+        if not budget['error'] and self._inputs_changed('php', self._php_context()):
+            self._config_php()
+            self._mark_applied('php', self._php_context())
+            restart_apache = True
+
+        if self.model.unit.is_leader():
+            self._reconcile_leader()
+        else:
+            self._reconcile_follower()
+
+        if self._stored.redis_info and \
+                self._inputs_changed('redis', dict(self._stored.redis_info)):
+            self._config_redis()
+            self._mark_applied('redis', dict(self._stored.redis_info))
+
+        if self._inputs_changed('tempdirectory', self.config.get('temp-dir')):
+            self._config_tempdirectory()
+            self._mark_applied('tempdirectory', self.config.get('temp-dir'))
+
+        if self._logging_context()['log_type'] in LOG_TYPES and \
+                self._inputs_changed('logging', self._logging_context()):
+            self._config_logging()
+            self._mark_applied('logging', self._logging_context())
+
+        if restart_apache:
+            try:
+                subprocess.check_call(['systemctl', 'restart', 'apache2.service'])
+            except subprocess.CalledProcessError as e:
+                print(e)
+                sys.exit(-1)
+
+        if self._stored.nextcloud_initialized and not self._stored.port_opened:
             open_port('80')
-        except subprocess.CalledProcessError as e:
-            print(e)
-            sys.exit(-1)
+            self._stored.port_opened = True
+
+        self._update_status()
+
+    def _reconcile_leader(self):
+        """
+        The leader installs nextcloud once the database is available
+        and keeps the trusted domains in line with the cluster peers.
+        """
+        if self.db is not None:
+            for relation in self.model.relations['db']:
+                if relation.data[self.app].get('database') != 'nextcloud':
+                    # Let _on_database_relation_joined set the requirements.
+                    self.db.on.database_relation_joined.emit(
+                        relation=relation, app=relation.app, unit=None,
+                        local_unit=self.model.unit)
+
+        if self._stored.database_available and not self._stored.nextcloud_initialized:
+            # occ runs as www-data, which can't create a data-dir outside the root.
+            self._make_www_data_dir(self.paths.data_dir)
+            self._set_directory_permissions()
+            self._init_nextcloud()
+            self._add_initial_trusted_domain()
+            installed = self.get_nextcloud_status()['installed']
+            if installed:
+                logger.debug("===== Nextcloud install_status: {}====".format(installed))
+                self._stored.nextcloud_initialized = True
+
+        if not self._stored.nextcloud_initialized:
+            return
+        chunk_size = self.config.get('chunked-upload-max-size')
+        if self._inputs_changed('chunk_size', chunk_size):
+            # Not marked applied when occ fails, so the next reconcile retries.
+            if self.occ.set_app_config('files', 'max_chunk_size', chunk_size).returncode == 0:
+                self._mark_applied('chunk_size', chunk_size)
+            else:
+                logger.error("Failed to set files max_chunk_size to %s", chunk_size)
+
+        if self.model.get_relation('cluster') is None or \
+                not os.path.exists(self.paths.config_php):
+            return
+        peer_ips = self._peer_ips()
+        if self._inputs_changed('trusted_domains', peer_ips):
+            self.update_config_php_trusted_domains(peer_ips)
+            self._mark_applied('trusted_domains', peer_ips)
+
+    def _reconcile_follower(self):
+        """
+        Followers copy the config.php published by the leader.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if cluster_rel is None:
+            return
+        nextcloud_config = cluster_rel.data[self.app].get('nextcloud_config')
+        if not nextcloud_config or not self._inputs_changed('config_php', nextcloud_config):
+            return
+        with open(self.paths.config_php, "w") as f:
+            f.write(nextcloud_config)
+        data_dir_path = self.paths.data_dir
+        ocdata_path = os.path.join(data_dir_path, '.ocdata')
+        if not os.path.exists(data_dir_path):
+            os.makedirs(data_dir_path)
+        if not os.path.exists(ocdata_path):
+            open(ocdata_path, 'a').close()
+        self._set_directory_permissions()
+        self._stored.database_available = True
+        self._stored.nextcloud_initialized = True
+        self._mark_applied('config_php', nextcloud_config)
+
+    def _reconcile_paths(self) -> bool:
+        """
+        Move the code root and data directory to where the config wants
+        them. Apache is stopped while moving, and nothing is moved onto an
+        existing non-empty directory: the unit then stays blocked on its
+        current paths. Returns False when blocked.
+        Stored paths are only saved when the hook succeeds, so a move done
+        by a hook failing later is found again and adopted on retry.
+        """
+        current, wanted = self.paths, self._wanted_paths()
+        self._stored.path_error = None
+        if (current.root, current.data_dir) == (wanted.root, wanted.data_dir):
+            return True
+        # The data directory moves along with the root when it is inside it.
+        data_dir = current.data_dir
+        if os.path.commonpath([current.root, data_dir]) == current.root:
+            data_dir = os.path.join(wanted.root, os.path.relpath(data_dir, current.root))
+        for old, new, marker in [(current.root, wanted.root, os.path.join('config', 'config.php')),
+                                 (data_dir, wanted.data_dir, '.ocdata')]:
+            if old != new and not self._can_move_into(new) and \
+                    not self._moved_already(old, new, marker):
+                self._stored.path_error = "{} is not empty, not moving there.".format(new)
+                logger.error(self._stored.path_error)
+                return False
+
+        self.unit.status = MaintenanceStatus("Moving nextcloud to {}.".format(wanted.root))
+        subprocess.call(['systemctl', 'stop', 'apache2.service'])
+        if current.root != wanted.root:
+            self._move_dir(current.root, wanted.root)
+            self._stored.nextcloud_root = wanted.root
+        if data_dir != wanted.data_dir:
+            self._move_dir(data_dir, wanted.data_dir)
+        self._stored.data_dir = wanted.data_dir
+        self._set_directory_permissions()
+        if current.data_dir != wanted.data_dir and self._stored.nextcloud_initialized and \
+                self.model.unit.is_leader():
+            self.occ.set_system_config('datadirectory', wanted.data_dir)
+            self._publish_config_php()
+        # Re-render everything pointing at the old paths, which restarts apache.
+        self._stored.applied = dict()
+        return True
+
+    @staticmethod
+    def _can_move_into(path) -> bool:
+        return not os.path.exists(path) or (os.path.isdir(path) and not os.listdir(path))
+
+    @staticmethod
+    def _moved_already(old, new, marker) -> bool:
+        """
+        True if old is gone and new holds what was in it, marker being
+        a file only the moved directory has.
+        """
+        return not os.path.exists(old) and os.path.exists(os.path.join(new, marker))
+
+    @staticmethod
+    def _move_dir(old, new):
+        """
+        Move old to new, which may be on another filesystem. Across
+        filesystems the copy completes before old is removed.
+        """
+        if not os.path.exists(old):
+            os.makedirs(new, exist_ok=True)
+            return
+        logger.info("Moving %s to %s", old, new)
+        if os.path.isdir(new):
+            os.rmdir(new)
+        os.makedirs(os.path.dirname(new), exist_ok=True)
+        started = time.monotonic()
+        shutil.move(old, new)
+        logger.info("Moved %s to %s in %.1fs", old, new, time.monotonic() - started)
+
+    def _inputs_changed(self, step, inputs) -> bool:
+        """
+        True if the reconcile step has not yet been applied with these inputs.
+        """
+        return self._stored.applied.get(step) != json.dumps(inputs, sort_keys=True)
+
+    def _mark_applied(self, step, inputs):
+        self._stored.applied[step] = json.dumps(inputs, sort_keys=True)
 
     # ACTIONS
 
     def _on_add_missing_indices_action(self, event):
-        o = Occ.db_add_missing_indices()
-        event.set_results({"occ-output": o})
+        o = self.occ.db_add_missing_indices()
+        event.set_results({"occ-output": o.stdout})
 
     def _on_convert_filecache_bigint_action(self, event):
         """
@@ -230,10 +541,10 @@ class NextcloudCharm(CharmBase):
         This action places the site in maintenance mode to protect it
         while this action runs.
         """
-        Occ.maintenance(enable=True)
-        o = Occ.convert_filecache_bigint()
-        event.set_results({"occ-output": o})
-        Occ.maintenance(enable=False)
+        self.occ.maintenance(enable=True)
+        o = self.occ.convert_filecache_bigint()
+        event.set_results({"occ-output": o.stdout})
+        self.occ.maintenance(enable=False)
 
     def _on_maintenance_action(self, event):
         """
@@ -241,44 +552,174 @@ class NextcloudCharm(CharmBase):
         :param event: boolean
         :return:
         """
-        o = Occ.maintenance(enable=event.params['enable'])
-        event.set_results({"occ-output": o})
+        o = self.occ.maintenance(enable=event.params['enable'])
+        event.set_results({"occ-output": o.stdout})
 
-    def _install_deps(self):
+    def _on_db_optimize_action(self, event):
         """
-        Install dependencies for running nextcloud.
+        Action adding missing indices, columns and primary keys via occ,
+        reporting size and dead tuple ratio of the busiest tables and
+        optionally running VACUUM (ANALYZE) on those above the threshold.
+        With dry-run nothing is changed, only what would be done is reported.
+        Nextcloud versions whose occ has no --dry-run can't tell what they
+        would change without changing it, changes is then not-evaluated.
         """
-        self.unit.status = MaintenanceStatus("Begin installing dependencies...")
+        if not self._stored.db_uri:
+            event.fail("No database connection, run this on the leader.")
+            return
+        # Units upgraded from a charm which didn't install postgresql-client lack psql.
+        if not shutil.which('psql'):
+            event.fail("psql not found, install postgresql-client.")
+            return
+        from dbmaint import (Postgres, parse_occ_changes,
+                             tables_to_vacuum, estimated_reclaim_bytes)
+        dry_run = event.params['dry-run']
+        occ = self.occ
+        changes, commands = [], []
+        if dry_run and not occ.has_option('db:add-missing-indices', '--dry-run'):
+            changes = 'not-evaluated'
+        else:
+            for command, occ_call in [('db:add-missing-indices', occ.db_add_missing_indices),
+                                      ('db:add-missing-columns', occ.db_add_missing_columns),
+                                      ('db:add-missing-primary-keys',
+                                       occ.db_add_missing_primary_keys)]:
+                output = occ_call(dry_run=dry_run)
+                result = {'command': command, 'exit-code': output.returncode}
+                if output.returncode == 0:
+                    changes.extend(parse_occ_changes(command, output.stdout))
+                else:
+                    # e.g. db:add-missing-primary-keys does not exist before nextcloud 19.
+                    result['error'] = (output.stderr or output.stdout).strip()
+                commands.append(result)
+
+        db = Postgres(self._stored.dbhost, self._stored.dbport, self._stored.dbname,
+                      self._stored.dbuser, self._stored.dbpass)
         try:
-            packages = ['apache2',
-                        'libapache2-mod-php7.2',
-                        'php7.2-gd',
-                        'php7.2-json',
-                        'php7.2-mysql',
-                        'php7.2-pgsql',
-                        'php7.2-curl',
-                        'php7.2-mbstring',
-                        'php7.2-intl',
-                        'php-imagick',
-                        'php7.2-zip',
-                        'php7.2-xml',
-                        'php-apcu',
-                        'php-redis',
-                        'php-smbclient']
-            command = ["apt", "install", "-y"]
-            command.extend(packages)
-            subprocess.run(command, check=True)
-            self.unit.status = MaintenanceStatus("Dependencies installed")
+            stats = db.table_stats()
+            candidates = tables_to_vacuum(stats, event.params['dead-ratio'])
+            vacuumed = []
+            if event.params['vacuum'] and not dry_run:
+                for table in candidates:
+                    db.vacuum_analyze(table)
+                    vacuumed.append(table)
         except subprocess.CalledProcessError as e:
-            print(e)
+            event.fail("psql failed: {}".format(e))
+            return
+        event.set_results({
+            'dry-run': dry_run,
+            'changes': changes if changes == 'not-evaluated' else json.dumps(changes),
+            'occ-commands': json.dumps(commands),
+            'tables': json.dumps(stats),
+            'vacuum-candidates': ','.join(candidates),
+            'vacuumed': ','.join(vacuumed),
+            'estimated-reclaim-bytes': estimated_reclaim_bytes(stats, candidates)
+        })
+
+    def _on_benchmark_action(self, event):
+        """
+        Action to benchmark WebDAV against this unit's own apache,
+        as a temporary user which is removed afterwards.
+        """
+        if not self._stored.nextcloud_initialized:
+            event.fail("Nextcloud not initialized.")
+            return
+        import secrets
+        from benchmark import WebdavBenchmark, OPERATIONS, parse_size
+        for param in ['concurrency', 'files']:
+            if event.params[param] < 1:
+                event.fail("{} must be at least 1.".format(param))
+                return
+        operations = [o.strip() for o in event.params['operations'].split(',')]
+        unknown = set(operations) - set(OPERATIONS)
+        if unknown:
+            event.fail("Unknown operations: {}".format(', '.join(sorted(unknown))))
+            return
+        sizes = event.params['sizes'].split(',')
+        invalid = []
+        for size in sizes:
+            try:
+                if parse_size(size) < 1:
+                    invalid.append(size)
+            except ValueError:
+                invalid.append(size)
+        if invalid:
+            event.fail("Invalid sizes: {}".format(', '.join(invalid)))
+            return
+        user = 'benchmark-{}'.format(secrets.token_hex(4))
+        password = secrets.token_urlsafe(24)
+        try:
+            self.occ.user_add(user, password)
+        except subprocess.CalledProcessError as e:
+            event.fail("Failed to create benchmark user: {}".format(e))
+            return
+        try:
+            bench = WebdavBenchmark('http://localhost', user, password,
+                                    concurrency=event.params['concurrency'])
+            results = bench.run(sizes=sizes,
+                                files=event.params['files'],
+                                operations=operations)
+            event.set_results(results)
+        finally:
+            self.occ.user_delete(user)
+
+    def _install_deps(self):
+        """
+        Start installing missing dependencies for running nextcloud.
+        Returns the running apt TimedProcess, or None when every
+        package is already installed.
+        """
+        missing = self._missing_packages(PACKAGES)
+        if not missing:
+            logger.info("All %d dependencies already installed", len(PACKAGES))
+            return None
+        self.unit.status = MaintenanceStatus(
+            "Installing {} packages...".format(len(missing)))
+        command = ["apt", "install", "-y"]
+        command.extend(missing)
+        return TimedProcess(command)
+
+    def _wait_for_deps(self, apt):
+        """
+        Wait for the apt process started by _install_deps to finish.
+        """
+        returncode = apt.wait()
+        logger.info("apt install completed in %.1fs", apt.elapsed)
+        if returncode != 0:
+            logger.error(subprocess.CalledProcessError(returncode, apt.args))
             sys.exit(-1)
+        self.unit.status = MaintenanceStatus("Dependencies installed")
 
-    def _fetch_and_extract_nextcloud(self):
+    @staticmethod
+    def _missing_packages(packages) -> list:
+        """
+        Return the packages not yet installed, using a single dpkg-query call.
+        """
+        command = ["dpkg-query", "-W", "-f=${Package} ${db:Status-Status}\\n"]
+        command.extend(packages)
+        # dpkg-query exits non-zero when some package is unknown,
+        # the known ones are still listed on stdout.
+        output = subprocess.run(command,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+        installed = set()
+        for line in output.splitlines():
+            name, _, status = line.partition(' ')
+            if status.strip() == 'installed':
+                installed.add(name.split(':')[0])
+        return [p for p in packages if p not in installed]
+
+    def _fetch_and_extract_nextcloud(self, apt=None):
         """
         Fetch and Install nextcloud from internet
         Sources are about 100M.
+        :param apt: the apt process running alongside, if any.
         """
-        self.unit.status = MaintenanceStatus("Begin fetching sources.")
+        if apt is not None and apt.running():
+            self.unit.status = MaintenanceStatus("Installing packages and fetching sources...")
+        else:
+            self.unit.status = MaintenanceStatus("Begin fetching sources.")
+        started = time.monotonic()
         import requests
         import tarfile
         # source = 'https://download.nextcloud.com/server/releases/nextcloud-18.0.3.tar.bz2'
@@ -286,15 +727,35 @@ class NextcloudCharm(CharmBase):
         # checksum = '7b67e709006230f90f95727f9fa92e8c73a9e93458b22103293120f9cb50fd72'
         try:
             response = requests.get(source, allow_redirects=True, stream=True)
-            dst = Path('/var/www/')
-            with tarfile.open(fileobj=BytesIO(response.content), mode='r:bz2') as tfile:
+            payload = BytesIO(response.content)
+            logger.info("Fetched sources in %.1fs", time.monotonic() - started)
+            # The tarball holds a nextcloud/ directory, extract it next to
+            # the root and rename it when the root is called differently.
+            # apache2 may not have created /var/www yet.
+            root = Path(self.paths.root)
+            dst = root.parent
+            dst.mkdir(parents=True, exist_ok=True)
+            with tarfile.open(fileobj=payload, mode='r:bz2') as tfile:
                 tfile.extractall(path=dst)
+            if root.name != 'nextcloud':
+                (dst / 'nextcloud').rename(root)
+            logger.info("Fetched and extracted sources in %.1fs", time.monotonic() - started)
             self.unit.status = MaintenanceStatus("Sources installed")
             self._stored.nextcloud_fetched = True
         except subprocess.CalledProcessError as e:
             print(e)
             sys.exit(-1)
 
+    def _render_template(self, name, target, ctx):
+        """
+        Render templates/<name> to target.
+        jinja2 is imported here so hooks that render nothing never load it.
+        """
+        from jinja2 import Environment, FileSystemLoader
+        template = Environment(
+            loader=FileSystemLoader(Path(self.charm_dir / 'templates'))).get_template(name)
+        target.write_text(template.render(ctx))
+
     def _config_php(self):
         """
         Renders the phpmodule for nextcloud (nextcloud.ini)
@@ -302,20 +763,91 @@ class NextcloudCharm(CharmBase):
         which might be overwitten or changed from elsewhere.
         """
         self.unit.status = MaintenanceStatus("Begin config php.")
-        phpmod_context = {
+        phpmod_context = self._php_context()
+        if phpmod_context['upload_tmp_dir']:
+            self._make_www_data_dir(phpmod_context['upload_tmp_dir'])
+        self._render_template('nextcloud.ini.j2',
+                              Path('/etc/php/7.2/mods-available/nextcloud.ini'),
+                              phpmod_context)
+        subprocess.check_call(['phpenmod', 'nextcloud'])
+        self._stored.php_configured = True
+        self.unit.status = MaintenanceStatus("php config complete.")
+
+    def _php_context(self) -> dict:
+        return {
             'max_file_uploads': self.config.get('php_max_file_uploads'),
             'upload_max_filesize': self.config.get('php_upload_max_filesize'),
             'post_max_size': self.config.get('php_post_max_size'),
-            'memory_limit': self.config.get('php_memory_limit')
+            'memory_limit': self.config.get('php_memory_limit'),
+            'upload_tmp_dir': self.paths.temp_dir,
+            'opcache_memory_consumption': OPCACHE_MEMORY_MB,
+            'opcache_interned_strings_buffer': OPCACHE_INTERNED_STRINGS_MB,
+            'apcu_shm_size': APCU_SHM_MB
         }
-        template = Environment(
-            loader=FileSystemLoader(
-                Path(self.charm_dir / 'templates'))).get_template('nextcloud.ini.j2')
-        target = Path('/etc/php/7.2/mods-available/nextcloud.ini')
-        target.write_text(template.render(phpmod_context))
-        subprocess.check_call(['phpenmod', 'nextcloud'])
-        self._stored.php_configured = True
-        self.unit.status = MaintenanceStatus("php config complete.")
+
+    def _memory_budget(self) -> dict:
+        """
+        How many php requests apache may run at once without swapping:
+        total memory, minus the memory-reserved config and php's shared
+        memory (OPcache, APCu), divided by php_memory_limit.
+        error is set when not even one request fits, or a size is invalid.
+        """
+        total = mem_total_bytes()
+        memory_limit = self.config.get('php_memory_limit')
+        budget = {'total': total, 'reserved': None, 'per_request': None,
+                  'workers': 0, 'error': None}
+        if str(memory_limit).strip() == '-1':
+            budget['error'] = "php_memory_limit -1 can not be budgeted, set a limit."
+            return budget
+        try:
+            reserved = self._config_size('memory-reserved', minimum=0)
+            per_request = self._config_size('php_memory_limit', minimum=1)
+        except ValueError as e:
+            budget['error'] = str(e)
+            return budget
+        budget['reserved'] = reserved + \
+            (OPCACHE_MEMORY_MB + OPCACHE_INTERNED_STRINGS_MB + APCU_SHM_MB) * 1024 ** 2
+        budget['per_request'] = per_request
+        budget['workers'] = max_php_workers(total, per_request, budget['reserved'])
+        if budget['workers'] < 1:
+            budget['error'] = ("php_memory_limit {} does not fit in {:.1f}G memory "
+                               "with {:.1f}G reserved.").format(
+                                   memory_limit, total / 1024 ** 3, budget['reserved'] / 1024 ** 3)
+        return budget
+
+    def _config_size(self, key, minimum) -> int:
+        """
+        A php shorthand size from config in bytes, raising ValueError
+        when it can't be parsed or is below minimum.
+        """
+        value = self.config.get(key)
+        try:
+            size = php_size_to_bytes(value)
+        except ValueError:
+            size = None
+        if size is None or size < minimum:
+            raise ValueError("invalid {} '{}'".format(key, value))
+        return size
+
+    def _config_tempdirectory(self):
+        """
+        Points the nextcloud tempdirectory at the temp-dir config,
+        through an overlay next to config.php, or removes the overlay
+        to go back to the system default.
+        """
+        target = Path(self.paths.overlay('tempdirectory'))
+        temp_dir = self.paths.temp_dir
+        if not temp_dir:
+            if target.exists():
+                target.unlink()
+            return
+        self._make_www_data_dir(temp_dir)
+        self._render_template('tempdirectory.config.php.j2', target, {'temp_dir': temp_dir})
+
+    @staticmethod
+    def _make_www_data_dir(path):
+        os.makedirs(path, exist_ok=True)
+        shutil.chown(path, 'www-data', 'www-data')
 
     def _init_nextcloud(self):
         """
@@ -330,7 +862,7 @@ class NextcloudCharm(CharmBase):
                'dbuser': self._stored.dbuser,
                'adminpassword': self.config.get('admin-password'),
                'adminusername': self.config.get('admin-username'),
-               'datadir': '/var/www/nextcloud/data'
+               'datadir': self.paths.data_dir
                }
         nextcloud_init = ("sudo -u www-data /usr/bin/php occ maintenance:install "
                           "--database {dbtype} --database-name {dbname} "
@@ -338,7 +870,7 @@ class NextcloudCharm(CharmBase):
                           "--database-user {dbuser} --admin-user {adminusername} "
                           "--admin-pass {adminpassword} "
                           "--data-dir {datadir} ").format(**ctx)
-        subprocess.call(nextcloud_init.split(), cwd='/var/www/nextcloud')
+        subprocess.call(nextcloud_init.split(), cwd=self.paths.root)
 
     def _add_initial_trusted_domain(self):
         """
@@ -349,35 +881,74 @@ class NextcloudCharm(CharmBase):
         """
         # Adds the fqdn to trusted domains (if set)
         if self.config['fqdn']:
-            Occ.add_trusted_domain(self.config['fqdn'], 1)
+            self.occ.add_trusted_domain(self.config['fqdn'], 1)
         ingress_addr = self.model.get_binding('website').network.ingress_address
         # Adds the ingress_address to trusted domains
-        Occ.add_trusted_domain(ingress_addr, 2)
+        self.occ.add_trusted_domain(ingress_addr, 2)
 
     def _set_directory_permissions(self):
-        subprocess.call("sudo chown -R www-data:www-data /var/www/nextcloud".split(),
-                        cwd='/var/www/nextcloud')
+        paths = self.paths
+        subprocess.call("sudo chown -R www-data:www-data {}".format(paths.root).split(),
+                        cwd=paths.root)
+        if os.path.commonpath([paths.root, paths.data_dir]) != paths.root and \
+                os.path.exists(paths.data_dir):
+            subprocess.call("sudo chown -R www-data:www-data {}".format(paths.data_dir).split(),
+                            cwd=paths.root)
 
     def _patch_config(self):
         # TODO: This is wrong and will also replace other values in config.php
         # BUG - perhaps add a config here with trusted_domains.
         # self.unit.ingress_address
-        Path('/var/www/nextcloud/config/config.php').write_text(
-            Path('/var/www/nextcloud/config/config.php').open().read().replace(
+        Path(self.paths.config_php).write_text(
+            Path(self.paths.config_php).open().read().replace(
                 "localhost", self.config.get('fqdn') or "127.0.0.1"))
         self.unit.status = MaintenanceStatus("Nextcloud init complete.")
 
+    def _apache_context(self) -> dict:
+        return {
+            'limit_request_body': self.config.get('apache_limit_request_body'),
+            'timeout': self.config.get('apache_timeout'),
+            'root': self.paths.root,
+            'max_request_workers': self._memory_budget()['workers'],
+            'log_dir': APACHE_LOG_DIR,
+            'access_log': self.config.get('apache_access_log'),
+            'buffered_logs': self.config.get('apache_buffered_logs'),
+            'log_rotate_count': self.config.get('apache_log_rotate_count'),
+            'log_rotate_size': self.config.get('apache_log_rotate_size')
+        }
+
+    def _logging_context(self) -> dict:
+        return {
+            'loglevel': self.config.get('log-level'),
+            'log_type': self.config.get('log-type'),
+            'logfile': self.config.get('log-file'),
+            'log_rotate_size': self.config.get('log-rotate-size')
+        }
+
+    def _config_logging(self):
+        """
+        Renders nextcloud's logging settings as an overlay next to config.php.
+        """
+        self._render_template('logging.config.php.j2',
+                              Path(self.paths.overlay('logging')),
+                              self._logging_context())
+
     def _config_apache2(self):
         """
         Configures apache2
         """
         self.unit.status = MaintenanceStatus("Begin config apache2.")
-        template = Environment(
-            loader=FileSystemLoader(Path(self.charm_dir / 'templates'))
-        ).get_template('nextcloud.conf.j2')
-        target = Path('/etc/apache2/sites-available/nextcloud.conf')
-        ctx = {}
-        target.write_text(template.render(ctx))
+        os.makedirs(APACHE_LOG_DIR, exist_ok=True)
+        self._render_template('nextcloud.conf.j2',
+                              Path('/etc/apache2/sites-available/nextcloud.conf'),
+                              self._apache_context())
+        self._render_template('nextcloud-apache.logrotate.j2',
+                              Path('/etc/logrotate.d/nextcloud-apache'),
+                              self._apache_context())
+        self._render_template('nextcloud-mpm.conf.j2',
+                              Path('/etc/apache2/conf-available/nextcloud-mpm.conf'),
+                              self._apache_context())
+        subprocess.check_call(['a2enconf', 'nextcloud-mpm'])
         # Enable required modules.
         for module in ['rewrite', 'headers', 'env', 'dir', 'mime']:
             subprocess.call(['a2enmod', module])
@@ -389,12 +960,21 @@ class NextcloudCharm(CharmBase):
         self.unit.status = MaintenanceStatus("apache2 config complete.")
 
     def _on_update_status(self, event):
+        self._reconcile()
+
+    def _update_status(self):
         """
         Evaluate the internal state to report on status.
         """
         if not self._stored.nextcloud_fetched:
             self.unit.status = BlockedStatus("Nextcloud not fetched.")
 
+        elif self._stored.path_error:
+            self.unit.status = BlockedStatus(self._stored.path_error)
+
+        elif self._stored.memory_error:
+            self.unit.status = BlockedStatus(self._stored.memory_error)
+
         elif not self._stored.nextcloud_initialized:
             self.unit.status = BlockedStatus("Nextcloud not initialized.")
 
@@ -407,10 +987,15 @@ class NextcloudCharm(CharmBase):
         elif not self._stored.database_available:
             self.unit.status = BlockedStatus("No database.")
 
+        elif self.config.get('log-type') not in LOG_TYPES:
+            self.unit.status = BlockedStatus(
+                "Invalid log-type, use one of {}.".format(', '.join(LOG_TYPES)))
+
         else:
             if self.model.unit.is_leader():
                 self.unit.set_workload_version(self.get_nextcloud_status()['version'])
-            self.unit.status = ActiveStatus("Ready")
+            self.unit.status = ActiveStatus("Ready, max {} php workers of {}".format(
+                self._memory_budget()['workers'], self.config.get('php_memory_limit')))
 
     def get_nextcloud_status(self) -> dict:
         """
@@ -420,7 +1005,7 @@ class NextcloudCharm(CharmBase):
         try:
             output = subprocess.run(ns.split(),
                                     stdout=subprocess.PIPE,
-                                    cwd='/var/www/nextcloud',
+                                    cwd=self.paths.root,
                                     universal_newlines=True).stdout
             returndict = json.loads(output.split()[-1])
         except subprocess.CalledProcessError as e:
@@ -432,12 +1017,12 @@ class NextcloudCharm(CharmBase):
         self._stored.redis_info = info
 
     def _on_redis_available(self, event):
-        template = Environment(
-            loader=FileSystemLoader(Path(self.charm_dir / 'templates'))
-        ).get_template('redis.config.php.j2')
-        target = Path('/var/www/nextcloud/config/redis.config.php')
-        ctx = self._stored.redis_info
-        target.write_text(template.render(ctx))
+        self._reconcile()
+
+    def _config_redis(self):
+        self._render_template('redis.config.php.j2',
+                              Path(self.paths.overlay('redis')),
+                              self._stored.redis_info)
 
 
 if __name__ == "__main__":
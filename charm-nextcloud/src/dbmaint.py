@@ -0,0 +1,88 @@
+"""Database maintenance helpers for the db-optimize action."""
+import logging
+import os
+import re
+from subprocess import run, PIPE
+
+logger = logging.getLogger(__name__)
+
+# Tables that grow and churn the most on a busy nextcloud.
+HOT_TABLES = ('oc_filecache', 'oc_activity', 'oc_jobs')
+
+# occ db:add-missing-* report each change as e.g.
+# "Adding additional fs_mtime index to the filecache table, this can take some time..."
+# "Adding primary key to the federated_reshares table, this can take some time..."
+OCC_CHANGE = re.compile(r'^Adding (?:additional )?(?P<change>.+?) to the (?P<table>\w+) table')
+
+TABLE_STATS_SQL = ("SELECT relname, pg_total_relation_size(relid), n_live_tup, n_dead_tup "
+                   "FROM pg_stat_user_tables WHERE relname IN ({}) ORDER BY relname")
+
+
+def parse_occ_changes(command, output) -> list:
+    """
+    Turn the output of an occ db:add-missing-* command into
+    a list of {'command', 'table', 'change'} dicts.
+    """
+    changes = []
+    for line in output.splitlines():
+        match = OCC_CHANGE.match(line.strip())
+        if match:
+            changes.append({'command': command,
+                            'table': match.group('table'),
+                            'change': match.group('change')})
+    return changes
+
+
+class Postgres:
+    """
+    Runs SQL with psql using the connection details of the db relation.
+    The password goes through the environment, not the command line.
+    """
+
+    def __init__(self, host, port, dbname, user, password):
+        self._args = ['psql', '--no-psqlrc', '-v', 'ON_ERROR_STOP=1',
+                      '-h', str(host), '-p', str(port), '-U', str(user), '-d', str(dbname)]
+        self._env = dict(os.environ, PGPASSWORD=str(password))
+
+    def query(self, sql) -> list:
+        """
+        Return the rows of sql as lists of strings.
+        """
+        output = run(self._args + ['-At', '-F', '|', '-c', sql], env=self._env,
+                     stdout=PIPE, universal_newlines=True, check=True).stdout
+        return [line.split('|') for line in output.splitlines() if line]
+
+    def table_stats(self, tables=HOT_TABLES) -> list:
+        """
+        Size and dead tuple ratio of tables, worst ratio first.
+        """
+        names = ', '.join("'{}'".format(t) for t in tables)
+        stats = []
+        for relname, size, live, dead in self.query(TABLE_STATS_SQL.format(names)):
+            live, dead = int(live), int(dead)
+            stats.append({'table': relname,
+                          'size-bytes': int(size),
+                          'live-tuples': live,
+                          'dead-tuples': dead,
+                          'dead-ratio': round(dead / (live + dead), 4) if live + dead else 0.0})
+        return sorted(stats, key=lambda s: s['dead-ratio'], reverse=True)
+
+    def vacuum_analyze(self, table):
+        logger.info("VACUUM (ANALYZE) %s", table)
+        run(self._args + ['-c', 'VACUUM (ANALYZE) {}'.format(table)], env=self._env,
+            stdout=PIPE, universal_newlines=True, check=True)
+
+
+def tables_to_vacuum(stats, threshold) -> list:
+    """
+    Tables whose dead tuple ratio reaches threshold, worst first.
+    """
+    return [s['table'] for s in stats if s['dead-tuples'] and s['dead-ratio'] >= threshold]
+
+
+def estimated_reclaim_bytes(stats, tables) -> int:
+    """
+    Rough space held by dead tuples in tables, assuming
+    dead rows are as large as live ones.
+    """
+    return int(sum(s['size-bytes'] * s['dead-ratio'] for s in stats if s['table'] in tables))
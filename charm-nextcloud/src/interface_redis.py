@@ -41,9 +41,10 @@ class RedisClient(Object):
         )
 
     def _on_relation_changed(self, event):
+        # Nothing to do until the redis unit publishes its data,
+        # which triggers another relation-changed.
         event_unit_data = event.relation.data.get(event.unit)
         if not event_unit_data:
-            event.defer()
             return
         password = event_unit_data.get('password')
         host = event_unit_data.get('hostname')
@@ -58,5 +59,3 @@ class RedisClient(Object):
             self.on.redis_available.emit()
         else:
             logger.info("REDIS INFO NOT AVAILABLE")
-            event.defer()
-            return
@@ -1,82 +1,135 @@
 from subprocess import run, call, PIPE
+import json
 import logging
+import os
+
+from paths import DEFAULT_ROOT
 
 logger = logging.getLogger(__name__)
 
 
 class Occ:
+    """
+    Runs occ commands of the nextcloud installed in root.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT):
+        self._root = root
 
-    @staticmethod
-    def add_trusted_domain(domain, index):
+    def _cmd(self, args):
+        return "sudo -u www-data php {occ} {args}".format(
+            occ=os.path.join(self._root, 'occ'), args=args).split()
+
+    def add_trusted_domain(self, domain, index):
         """
         Adds a trusted domain to nextcloud config.php with occ
         """
-        cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set "
-                                  "trusted_domains {index} "
-                                  " --value={domain} ").format(index=index, domain=domain)
-        call(cmd.split(), cwd='/var/www/nextcloud')
+        cmd = self._cmd("config:system:set trusted_domains {index} "
+                        "--value={domain}".format(index=index, domain=domain))
+        call(cmd, cwd=self._root)
 
-    @staticmethod
-    def remove_trusted_domain(domain):
+    def remove_trusted_domain(self, domain):
         """
         Removes a trused domain from nextcloud with occ
         """
-        current_domains = Occ.get_trusted_domains()
+        current_domains = self.get_trusted_domains()
         if domain in current_domains:
             current_domains.remove(domain)
-            # First delete all trusted domains from config.php
-            # since they might have indices not in order.
-            Occ.remove_all_trusted_domains()
-            if current_domains:
-                # Now, add all the domains with indices in order starting from 0
-                for index, domain in enumerate(current_domains):
-                    Occ.add_trusted_domain(domain, index)
-
-    @staticmethod
-    def remove_all_trusted_domains():
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-                                  config:system:delete trusted_domains"
-        run(cmd.split(), cwd='/var/www/nextcloud')
-
-    @staticmethod
-    def get_trusted_domains():
+            self.set_trusted_domains(current_domains)
+
+    def remove_all_trusted_domains(self):
+        cmd = self._cmd("config:system:delete trusted_domains")
+        run(cmd, cwd=self._root)
+
+    def get_trusted_domains(self):
         """
         Get all current trusted domains in config.php with occ
         return list
         """
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-                           config:system:get trusted_domains"
-        output = run(cmd.split(), cwd='/var/www/nextcloud',
+        cmd = self._cmd("config:system:get trusted_domains")
+        output = run(cmd, cwd=self._root,
                      stdout=PIPE, universal_newlines=True)
         domains = output.stdout.split()
         return domains
 
-    @staticmethod
-    def update_trusted_domains_peer_ips(domains):
-        current_domains = Occ.get_trusted_domains()
+    def update_trusted_domains_peer_ips(self, domains):
+        current_domains = self.get_trusted_domains()
         # Copy 'localhost' and fqdn but replace all peers IP:s
         # with the ones currently available in the relation.
         new_domains = current_domains[0:2] + domains[:]
-        Occ.remove_all_trusted_domains()
-        for index, d in enumerate(new_domains):
-            Occ.add_trusted_domain(d, index)
-
-    @staticmethod
-    def db_add_missing_indices():
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ db:add-missing-indices"
-        output = run(cmd.split(), cwd='/var/www/nextcloud', stdout=PIPE, universal_newlines=True)
+        self.set_trusted_domains(new_domains)
+
+    def set_trusted_domains(self, domains):
+        """
+        Replaces all trusted domains, with indices in order starting from 0,
+        in a single occ call however many domains there are.
+        """
+        cmd = self._cmd("config:import")
+        config = json.dumps({'system': {'trusted_domains': list(domains)}})
+        run(cmd, cwd=self._root, input=config, universal_newlines=True)
+
+    def set_system_config(self, key, value):
+        """
+        Sets a config.php value with occ
+        """
+        cmd = self._cmd("config:system:set {key} --value={value}".format(key=key, value=value))
+        return run(cmd, cwd=self._root, stdout=PIPE, universal_newlines=True, check=True)
+
+    def set_app_config(self, app, key, value):
+        """
+        Sets an app config value with occ
+        """
+        cmd = self._cmd("config:app:set {app} {key} --value={value}".format(
+            app=app, key=key, value=value))
+        return run(cmd, cwd=self._root)
+
+    def user_add(self, user, password):
+        """
+        Adds a nextcloud user with occ, the password is passed
+        through the environment to keep it off the command line.
+        """
+        cmd = self._cmd("user:add --password-from-env {user}".format(user=user))
+        cmd[1:1] = ['--preserve-env=OC_PASS']
+        env = dict(os.environ, OC_PASS=password)
+        return run(cmd, cwd=self._root, env=env,
+                   stdout=PIPE, universal_newlines=True, check=True)
+
+    def user_delete(self, user):
+        cmd = self._cmd("user:delete {user}".format(user=user))
+        return run(cmd, cwd=self._root, stdout=PIPE, universal_newlines=True)
+
+    def has_option(self, command, option):
+        """
+        Whether an occ command takes option, e.g. --dry-run,
+        which depends on the nextcloud version.
+        """
+        cmd = self._cmd("help {}".format(command))
+        output = run(cmd, cwd=self._root, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        return output.returncode == 0 and option in output.stdout.split()
+
+    def _db_add_missing(self, what, dry_run):
+        cmd = self._cmd("db:add-missing-{}".format(what))
+        if dry_run:
+            cmd.append('--dry-run')
+        output = run(cmd, cwd=self._root, stdout=PIPE, stderr=PIPE, universal_newlines=True)
         return output
 
-    @staticmethod
-    def convert_filecache_bigint():
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-               db:convert-filecache-bigint --no-interaction"
-        output = run(cmd.split(), cwd='/var/www/nextcloud', stdout=PIPE, universal_newlines=True)
+    def db_add_missing_indices(self, dry_run=False):
+        return self._db_add_missing('indices', dry_run)
+
+    def db_add_missing_columns(self, dry_run=False):
+        return self._db_add_missing('columns', dry_run)
+
+    def db_add_missing_primary_keys(self, dry_run=False):
+        return self._db_add_missing('primary-keys', dry_run)
+
+    def convert_filecache_bigint(self):
+        cmd = self._cmd("db:convert-filecache-bigint --no-interaction")
+        output = run(cmd, cwd=self._root, stdout=PIPE, universal_newlines=True)
         return output
 
-    @staticmethod
-    def maintenance(enable):
+    def maintenance(self, enable):
         m = "--on" if enable else "--off"
-        cmd = f"sudo -u www-data php /var/www/nextcloud/occ maintenance:mode {m}"
-        output = run(cmd.split(), cwd='/var/www/nextcloud', stdout=PIPE, universal_newlines=True)
+        cmd = self._cmd(f"maintenance:mode {m}")
+        output = run(cmd, cwd=self._root, stdout=PIPE, universal_newlines=True)
         return output
@@ -0,0 +1,38 @@
+"""Filesystem layout of a nextcloud unit."""
+import os
+
+DEFAULT_ROOT = '/var/www/nextcloud'
+
+
+class NextcloudPaths:
+    """
+    Where the nextcloud code, its config, user data and temporary
+    files live. Everything touching the filesystem goes through this,
+    so code and data can be placed on separate (fast) volumes.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, data_dir=None, temp_dir=None):
+        self.root = os.path.abspath(root)
+        self.data_dir = os.path.abspath(data_dir) if data_dir else os.path.join(self.root, 'data')
+        self.temp_dir = os.path.abspath(temp_dir) if temp_dir else None
+
+    @property
+    def config_dir(self):
+        return os.path.join(self.root, 'config')
+
+    @property
+    def config_php(self):
+        return os.path.join(self.config_dir, 'config.php')
+
+    def overlay(self, name):
+        """
+        Path of a <name>.config.php overlay, which nextcloud reads after config.php.
+        """
+        return os.path.join(self.config_dir, '{}.config.php'.format(name))
+
+    def __eq__(self, other):
+        return isinstance(other, NextcloudPaths) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return 'NextcloudPaths(root={!r}, data_dir={!r}, temp_dir={!r})'.format(
+            self.root, self.data_dir, self.temp_dir)
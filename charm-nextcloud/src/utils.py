@@ -1,4 +1,6 @@
-from subprocess import run
+from subprocess import run, Popen
+import threading
+import time
 
 
 def _modify_port(start=None, end=None, protocol='tcp', hook_tool="open-port"):
@@ -30,3 +32,62 @@ def open_port(start, end=None, protocol="tcp"):
 
 def close_port(start, end=None, protocol="tcp"):
     _modify_port(start, end, protocol=protocol, hook_tool="close-port")
+
+
+PHP_SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def php_size_to_bytes(value):
+    """
+    Convert php shorthand sizes such as 512M or 1G to bytes.
+    Returns None for -1 (no limit).
+    """
+    value = str(value).strip().upper()
+    if value == '-1':
+        return None
+    if value[-1:] in PHP_SIZE_UNITS:
+        return int(value[:-1]) * PHP_SIZE_UNITS[value[-1]]
+    return int(value)
+
+
+def mem_total_bytes(meminfo='/proc/meminfo'):
+    with open(meminfo) as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                # The value is in kB
+                return int(line.split()[1]) * 1024
+    raise ValueError("MemTotal not found in {}".format(meminfo))
+
+
+def max_php_workers(total, per_request, reserved):
+    """
+    How many php requests can run at once, each using up to
+    per_request bytes, in total bytes of memory minus reserved.
+    """
+    return max(0, (total - reserved) // per_request)
+
+
+class TimedProcess:
+    """
+    A command running in the background. How long it ran is recorded
+    when it exits, not when the caller gets around to waiting for it.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.elapsed = None
+        self._started = time.monotonic()
+        self._process = Popen(args)
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        self._process.wait()
+        self.elapsed = time.monotonic() - self._started
+
+    def running(self) -> bool:
+        return self._watcher.is_alive()
+
+    def wait(self) -> int:
+        self._watcher.join()
+        return self._process.returncode
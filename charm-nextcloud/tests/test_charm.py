@@ -1,11 +1,25 @@
 # Copyright 2020 Erik Lönroth
 # See LICENSE file for licensing details.
 
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-# from unittest.mock import Mock
+from pathlib import Path
+from unittest.mock import Mock, patch
 
+from ops.model import BlockedStatus
 from ops.testing import Harness
 from charm import NextcloudCharm
+from benchmark import WebdavBenchmark, parse_size, percentile
+from dbmaint import parse_occ_changes, tables_to_vacuum, estimated_reclaim_bytes
+from occ import Occ
+from paths import NextcloudPaths
+from utils import php_size_to_bytes, TimedProcess
 
 
 class TestCharm(unittest.TestCase):
@@ -40,3 +54,629 @@ class TestCharm(unittest.TestCase):
         harness.begin()
         harness.charm._fetch_and_extract_nextcloud()
         self.assertTrue(harness.charm._stored.nextcloud_fetched)
+
+    def test_missing_packages(self):
+        dpkg_output = ("apache2 installed\n"
+                       "php-apcu not-installed\n"
+                       "php-redis:amd64 installed\n")
+        with patch('charm.subprocess.run') as run:
+            run.return_value = Mock(stdout=dpkg_output)
+            missing = NextcloudCharm._missing_packages(['apache2', 'php-apcu',
+                                                        'php-redis', 'php-smbclient'])
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(missing, ['php-apcu', 'php-smbclient'])
+
+    def test_install_skips_apt_when_nothing_missing(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.nextcloud_fetched = True
+        with patch.object(NextcloudCharm, '_missing_packages', return_value=[]), \
+                patch('charm.TimedProcess') as apt:
+            harness.charm.on.install.emit()
+        self.assertFalse(apt.called)
+
+    def test_install_waits_for_apt_when_fetch_fails(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        with patch.object(NextcloudCharm, '_missing_packages', return_value=['apache2']), \
+                patch.object(NextcloudCharm, '_fetch_and_extract_nextcloud',
+                             side_effect=ConnectionError), \
+                patch('charm.TimedProcess') as apt:
+            apt.return_value.wait.return_value = 0
+            with self.assertRaises(ConnectionError):
+                harness.charm.on.install.emit()
+        self.assertTrue(apt.return_value.wait.called)
+
+    def test_timed_process_records_its_own_run_time(self):
+        process = TimedProcess([sys.executable, '-c', 'pass'])
+        time.sleep(1)
+        self.assertEqual(process.wait(), 0)
+        self.assertLess(process.elapsed, 1)
+
+    def test_reconcile_skips_unchanged_steps(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.nextcloud_fetched = True
+        with patch.object(NextcloudCharm, '_config_apache2') as apache, \
+                patch.object(NextcloudCharm, '_config_php') as php, \
+                patch.object(NextcloudCharm, '_config_logging'), \
+                patch('charm.subprocess.check_call') as check_call:
+            harness.charm.on.config_changed.emit()
+            harness.charm.on.update_status.emit()
+            self.assertEqual(apache.call_count, 1)
+            self.assertEqual(php.call_count, 1)
+            self.assertEqual(check_call.call_count, 1)
+            harness.update_config({'php_max_file_uploads': 50})
+            self.assertEqual(apache.call_count, 1)
+            self.assertEqual(php.call_count, 2)
+            self.assertEqual(check_call.call_count, 2)
+
+    def test_deferred_pgsql_event_survives_update_status(self):
+        # The pgsql client defers relation-changed arriving before joined.
+        first = Harness(NextcloudCharm)
+        self.addCleanup(first.cleanup)
+        first.begin()
+        rel_id = first.add_relation('db', 'postgresql')
+        relation = first.model.get_relation('db', rel_id)
+        first.charm.on.db_relation_changed.emit(relation, relation.app)
+        notices = list(first.framework._storage.notices())
+        self.assertEqual(len(notices), 1)
+
+        # A later update-status hook, which doesn't load the client by itself.
+        second = Harness(NextcloudCharm)
+        self.addCleanup(second.cleanup)
+        second.add_relation('db', 'postgresql')
+        for event_path, observer_path, method in notices:
+            second.framework._storage.save_snapshot(
+                event_path, first.framework._storage.load_snapshot(event_path))
+            second.framework._storage.save_notice(event_path, observer_path, method)
+        with patch.dict(os.environ, {'JUJU_UNIT_NAME': 'nextcloud/0',
+                                     'JUJU_DISPATCH_PATH': 'hooks/update-status'}):
+            second.begin()
+        self.assertIsNotNone(second.charm.db)
+        second.framework.reemit()
+        # Re-emitted to the client, which defers it again, instead of dropped.
+        self.assertEqual(list(second.framework._storage.notices()), notices)
+
+    def test_new_leader_sets_missing_db_requirements(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.nextcloud_fetched = True
+        # Leadership settings, which the client mirrors the requirements to.
+        client = sys.modules[type(harness.charm.db).__module__]
+        with patch.object(client, '_get_pgsql_leader_data', return_value={}), \
+                patch.object(client, '_set_pgsql_leader_data'), \
+                patch.object(NextcloudCharm, '_config_apache2'), \
+                patch.object(NextcloudCharm, '_config_php'), \
+                patch.object(NextcloudCharm, '_config_logging'), \
+                patch('charm.subprocess.check_call'):
+            # Joined while no unit was leader, so nobody set the requirements.
+            rel_id = harness.add_relation('db', 'postgresql')
+            harness.add_relation_unit(rel_id, 'postgresql/0')
+            self.assertNotIn('database', harness.get_relation_data(rel_id, 'nextcloud'))
+            harness.set_leader(True)
+        app_data = harness.get_relation_data(rel_id, 'nextcloud')
+        self.assertEqual(app_data['database'], 'nextcloud')
+        self.assertEqual(app_data['extensions'], 'citext')
+
+    def test_chunk_size_retried_after_occ_failure(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        harness.charm._stored.nextcloud_initialized = True
+        with patch.object(Occ, 'set_app_config') as set_app_config:
+            set_app_config.return_value = Mock(returncode=1)
+            harness.charm._reconcile_leader()
+            set_app_config.return_value = Mock(returncode=0)
+            harness.charm._reconcile_leader()
+            harness.charm._reconcile_leader()
+        self.assertEqual(set_app_config.call_count, 2)
+
+    def test_start_before_initialized_does_not_defer(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm.on.start.emit()
+        self.assertEqual(list(harness.framework._storage.notices()), [])
+        self.assertEqual(harness.charm.unit.status.message, "Nextcloud not fetched.")
+
+    def test_php_ini_large_upload_profile(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'temp-dir': '/srv/nextcloud-tmp'})
+        harness.begin()
+        with tempfile.TemporaryDirectory() as tmp:
+            target = Path(tmp, 'nextcloud.ini')
+            harness.charm._render_template('nextcloud.ini.j2', target,
+                                           harness.charm._php_context())
+            lines = target.read_text().splitlines()
+        self.assertIn('upload_max_filesize = 512M', lines)
+        self.assertIn('post_max_size = 512M', lines)
+        self.assertIn('upload_tmp_dir = /srv/nextcloud-tmp', lines)
+        self.assertIn('output_buffering = 0', lines)
+        self.assertFalse([line for line in lines if '=>' in line])
+
+    def test_logging_overlay_and_vhost(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'log-type': 'systemd', 'log-level': 3,
+                               'apache_access_log': False, 'apache_buffered_logs': True})
+        harness.begin()
+        with tempfile.TemporaryDirectory() as tmp:
+            overlay = Path(tmp, 'logging.config.php')
+            harness.charm._render_template('logging.config.php.j2', overlay,
+                                           harness.charm._logging_context())
+            vhost = Path(tmp, 'nextcloud.conf')
+            harness.charm._render_template('nextcloud.conf.j2', vhost,
+                                           harness.charm._apache_context())
+            overlay, vhost = overlay.read_text(), vhost.read_text()
+        self.assertIn("'loglevel' => 3,", overlay)
+        self.assertIn("'log_type' => 'systemd',", overlay)
+        self.assertNotIn("'logfile'", overlay)
+        self.assertIn("BufferedLogs On", vhost)
+        self.assertNotIn("CustomLog", vhost)
+        self.assertIn("ErrorLog /var/log/apache2/nextcloud/nextcloud-error.log", vhost)
+
+    def test_invalid_log_type_blocks(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'log-type': 'papertrail'})
+        harness.begin()
+        for flag in ['nextcloud_fetched', 'nextcloud_initialized', 'apache_configured',
+                     'php_configured', 'database_available']:
+            setattr(harness.charm._stored, flag, True)
+        harness.charm._update_status()
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+
+    def test_memory_budget(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'php_memory_limit': '512M', 'memory-reserved': '1G'})
+        harness.begin()
+        with patch('charm.mem_total_bytes', return_value=8 * 1024 ** 3):
+            budget = harness.charm._memory_budget()
+            ctx = harness.charm._apache_context()
+        # 8G - 1G reserved - 168M opcache/apcu = 6.8G, 13 workers of 512M
+        self.assertEqual(budget['workers'], 13)
+        self.assertIsNone(budget['error'])
+        self.assertEqual(ctx['max_request_workers'], 13)
+        with tempfile.TemporaryDirectory() as tmp:
+            target = Path(tmp, 'nextcloud-mpm.conf')
+            harness.charm._render_template('nextcloud-mpm.conf.j2', target, ctx)
+            mpm = target.read_text()
+        self.assertIn('MaxRequestWorkers 13', mpm)
+        self.assertIn('ServerLimit 13', mpm)
+
+    def test_memory_budget_blocks_when_nothing_fits(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'php_memory_limit': '4G'})
+        harness.begin()
+        harness.charm._stored.nextcloud_fetched = True
+        with patch('charm.mem_total_bytes', return_value=2 * 1024 ** 3), \
+                patch.object(NextcloudCharm, '_config_apache2') as apache, \
+                patch.object(NextcloudCharm, '_config_php') as php, \
+                patch.object(NextcloudCharm, '_config_logging'):
+            harness.charm.on.config_changed.emit()
+        self.assertFalse(apache.called)
+        self.assertFalse(php.called)
+        self.assertIsInstance(harness.charm.unit.status, BlockedStatus)
+        self.assertIn('php_memory_limit 4G', harness.charm.unit.status.message)
+
+    def test_memory_budget_blocks_on_invalid_sizes(self):
+        for config, message in [({'php_memory_limit': '0'}, "invalid php_memory_limit '0'"),
+                                ({'php_memory_limit': '1.5G'}, "invalid php_memory_limit '1.5G'"),
+                                ({'memory-reserved': '512MB'}, "invalid memory-reserved '512MB'")]:
+            harness = Harness(NextcloudCharm)
+            self.addCleanup(harness.cleanup)
+            harness.update_config(config)
+            harness.begin()
+            harness.charm._stored.nextcloud_fetched = True
+            with patch('charm.mem_total_bytes', return_value=8 * 1024 ** 3), \
+                    patch.object(NextcloudCharm, '_config_logging'), \
+                    patch.object(NextcloudCharm, '_config_tempdirectory'):
+                harness.charm.on.update_status.emit()
+            self.assertEqual(harness.charm.unit.status, BlockedStatus(message))
+
+    def test_php_size_to_bytes(self):
+        self.assertEqual(php_size_to_bytes('512M'), 512 * 1024 ** 2)
+        self.assertEqual(php_size_to_bytes('1g'), 1024 ** 3)
+        self.assertEqual(php_size_to_bytes('1048576'), 1048576)
+        self.assertIsNone(php_size_to_bytes('-1'))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('4K'), 4096)
+        self.assertEqual(parse_size('16mb'), 16 * 1024 ** 2)
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 95), 95)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertIsNone(percentile([], 50))
+
+    def test_run_reports_each_workload(self):
+        session = Mock()
+        session.request.side_effect = lambda method, url, **kw: Mock(
+            status_code=500 if method == 'GET' and url.endswith('-0') else 201)
+        bench = WebdavBenchmark('http://localhost', 'bench', 'secret',
+                                concurrency=2, session_factory=lambda: session)
+        results = bench.run(sizes=['4K'], files=4)
+        self.assertEqual(sorted(results), ['get-4k', 'propfind-4k', 'put-4k'])
+        self.assertEqual(results['put-4k']['errors'], 0)
+        self.assertEqual(results['get-4k']['errors'], 1)
+        self.assertEqual(results['get-4k']['error-rate'], 0.25)
+        self.assertIn('p99-ms', results['propfind-4k'])
+        methods = [c[0][0] for c in session.request.call_args_list]
+        self.assertEqual(methods.count('DELETE'), 4)
+
+    def test_action_rejects_bad_params(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.nextcloud_initialized = True
+        defaults = {'operations': 'put', 'sizes': '4K', 'concurrency': 4, 'files': 20}
+        for params, message in [({'operations': 'put,gte'}, "Unknown operations: gte"),
+                                ({'sizes': '4K,lots,0'}, "Invalid sizes: lots, 0"),
+                                ({'concurrency': 0}, "concurrency must be at least 1."),
+                                ({'files': 0}, "files must be at least 1.")]:
+            action_event = Mock(params=dict(defaults, **params))
+            with patch.object(Occ, 'user_add') as user_add:
+                harness.charm._on_benchmark_action(action_event)
+            action_event.fail.assert_called_once_with(message)
+            self.assertFalse(user_add.called)
+
+
+class TestDbOptimize(unittest.TestCase):
+    STATS = [{'table': 'oc_filecache', 'size-bytes': 1000, 'live-tuples': 70,
+              'dead-tuples': 30, 'dead-ratio': 0.3},
+             {'table': 'oc_jobs', 'size-bytes': 100, 'live-tuples': 99,
+              'dead-tuples': 1, 'dead-ratio': 0.01}]
+
+    def test_parse_occ_changes(self):
+        output = ("Check indices of the share table.\n"
+                  "Adding additional share_with index to the share table, "
+                  "this can take some time...\n"
+                  "Share table updated successfully.\n"
+                  "Adding primary key to the federated_reshares table, "
+                  "this can take some time...\n")
+        self.assertEqual(parse_occ_changes('db:add-missing-indices', output), [
+            {'command': 'db:add-missing-indices', 'table': 'share', 'change': 'share_with index'},
+            {'command': 'db:add-missing-indices', 'table': 'federated_reshares',
+             'change': 'primary key'}])
+
+    def test_tables_to_vacuum(self):
+        self.assertEqual(tables_to_vacuum(self.STATS, 0.1), ['oc_filecache'])
+        self.assertEqual(estimated_reclaim_bytes(self.STATS, ['oc_filecache']), 300)
+
+    def _run_action(self, params, has_dry_run=True, psql='/usr/bin/psql'):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.db_uri = 'postgresql://nextcloud@db/nextcloud'
+        for key in ['dbhost', 'dbport', 'dbname', 'dbuser', 'dbpass']:
+            setattr(harness.charm._stored, key, key)
+        action_event = Mock(params=params)
+        occ_output = Mock(stdout="Adding additional fs_mtime index to the filecache table\n",
+                          returncode=0)
+        missing = Mock(stdout="", stderr='Command "db:add-missing-primary-keys" is not defined.',
+                       returncode=1)
+        with patch('dbmaint.Postgres') as postgres, \
+                patch('charm.shutil.which', return_value=psql), \
+                patch.object(Occ, 'has_option', return_value=has_dry_run), \
+                patch.object(Occ, 'db_add_missing_indices', return_value=occ_output) as idx, \
+                patch.object(Occ, 'db_add_missing_columns',
+                             return_value=Mock(stdout="", returncode=0)), \
+                patch.object(Occ, 'db_add_missing_primary_keys', return_value=missing):
+            postgres.return_value.table_stats.return_value = self.STATS
+            harness.charm._on_db_optimize_action(action_event)
+        return action_event, idx, postgres.return_value
+
+    def test_db_optimize(self):
+        action_event, idx, db = self._run_action({'vacuum': True, 'dead-ratio': 0.1,
+                                                  'dry-run': False})
+        results = action_event.set_results.call_args[0][0]
+        idx.assert_called_once_with(dry_run=False)
+        self.assertEqual(json.loads(results['changes'])[0]['table'], 'filecache')
+        db.vacuum_analyze.assert_called_once_with('oc_filecache')
+        self.assertEqual(results['vacuumed'], 'oc_filecache')
+
+    def test_db_optimize_reports_failed_commands(self):
+        action_event, _, _ = self._run_action({'vacuum': False, 'dead-ratio': 0.1,
+                                               'dry-run': False})
+        commands = json.loads(action_event.set_results.call_args[0][0]['occ-commands'])
+        self.assertEqual([c['exit-code'] for c in commands], [0, 0, 1])
+        self.assertNotIn('error', commands[0])
+        self.assertIn('is not defined', commands[2]['error'])
+
+    def test_db_optimize_dry_run(self):
+        action_event, idx, db = self._run_action({'vacuum': True, 'dead-ratio': 0.1,
+                                                  'dry-run': True})
+        results = action_event.set_results.call_args[0][0]
+        idx.assert_called_once_with(dry_run=True)
+        self.assertEqual(json.loads(results['changes'])[0]['table'], 'filecache')
+        self.assertFalse(db.vacuum_analyze.called)
+        self.assertEqual(results['vacuum-candidates'], 'oc_filecache')
+        self.assertEqual(results['estimated-reclaim-bytes'], 300)
+
+    def test_db_optimize_dry_run_without_occ_support(self):
+        action_event, idx, _ = self._run_action({'vacuum': False, 'dead-ratio': 0.1,
+                                                 'dry-run': True}, has_dry_run=False)
+        results = action_event.set_results.call_args[0][0]
+        self.assertFalse(idx.called)
+        self.assertEqual(results['changes'], 'not-evaluated')
+
+    def test_db_optimize_without_psql(self):
+        action_event, idx, _ = self._run_action({'vacuum': False, 'dead-ratio': 0.1,
+                                                 'dry-run': False}, psql=None)
+        self.assertTrue(action_event.fail.called)
+        self.assertFalse(action_event.set_results.called)
+        self.assertFalse(idx.called)
+
+
+class ReconcileTestCase(unittest.TestCase):
+    """
+    Base for tests running whole reconciles: rendering config, chown
+    and the commands managing apache and ports are stubbed out.
+    """
+
+    def setUp(self):
+        for target in ['_config_apache2', '_config_php', '_config_logging',
+                       '_config_tempdirectory', '_set_directory_permissions']:
+            self._start(patch.object(NextcloudCharm, target))
+        for target in ['charm.subprocess.call', 'charm.subprocess.check_call',
+                       'charm.open_port']:
+            self._start(patch(target))
+
+    def _start(self, patcher):
+        mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock
+
+
+class TestClusterScale(ReconcileTestCase):
+    """
+    Simulates peers joining and departing a large cluster, checking the
+    trusted domains stay right and occ runs a bounded number of times per
+    hook, whatever the cluster size. nextcloud-root points at a temporary
+    directory standing in for /var/www/nextcloud.
+    """
+    PEERS = 200
+    # config:system:get and config:import
+    MAX_OCC_PER_HOOK = 2
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        Path(self.root.name, 'config').mkdir()
+        Path(self.root.name, 'config', 'config.php').write_text("<?php $CONFIG = array();")
+        self.occ_calls = []
+        self.trusted_domains = ['localhost', 'cloud.example.com']
+        for target in ['occ.run', 'occ.call']:
+            self._start(patch(target, side_effect=self._fake_occ))
+
+    def _fake_occ(self, cmd, **kwargs):
+        self.occ_calls.append(cmd)
+        if 'config:system:get' in cmd:
+            return Mock(stdout='\n'.join(self.trusted_domains))
+        if 'config:import' in cmd:
+            self.trusted_domains = json.loads(kwargs['input'])['system']['trusted_domains']
+            Path(self.root.name, 'config', 'config.php').write_text(
+                "<?php $CONFIG = {};".format(json.dumps(self.trusted_domains)))
+        return Mock(stdout='')
+
+    def _harness(self, leader):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(leader)
+        harness.update_config({'nextcloud-root': self.root.name})
+        harness.begin()
+        harness.charm._stored.nextcloud_root = self.root.name
+        harness.charm._stored.data_dir = os.path.join(self.root.name, 'data')
+        harness.charm._stored.nextcloud_fetched = True
+        harness.charm._stored.nextcloud_initialized = leader
+        harness.charm._stored.database_available = leader
+        return harness
+
+    def _hook(self, trigger, *args):
+        """
+        Run one hook through the harness, returning how many times it ran occ.
+        """
+        before = len(self.occ_calls)
+        trigger(*args)
+        return len(self.occ_calls) - before
+
+    def test_join_and_depart(self):
+        harness = self._harness(leader=True)
+        harness.charm._mark_applied('chunk_size', harness.charm.config['chunked-upload-max-size'])
+        rel_id = harness.add_relation('cluster', 'nextcloud')
+        harness.update_relation_data(rel_id, 'nextcloud/0', {'ingress-address': '10.0.0.1'})
+        rng = random.Random(42)
+        addresses = {}
+        per_hook = []
+        for n in range(1, self.PEERS + 1):
+            unit = 'nextcloud/{}'.format(n)
+            addresses[unit] = '10.{}.{}.{}'.format(rng.randrange(1, 255),
+                                                   rng.randrange(255), rng.randrange(1, 255))
+            per_hook.append(self._hook(harness.add_relation_unit, rel_id, unit))
+            per_hook.append(self._hook(harness.update_relation_data, rel_id, unit,
+                                       {'ingress-address': addresses[unit]}))
+
+        for unit in rng.sample(sorted(addresses), self.PEERS // 2):
+            per_hook.append(self._hook(harness.remove_relation_unit, rel_id, unit))
+            del addresses[unit]
+
+        self.assertLessEqual(max(per_hook), self.MAX_OCC_PER_HOOK)
+        self.assertEqual(self.trusted_domains[:2], ['localhost', 'cloud.example.com'])
+        self.assertEqual(sorted(self.trusted_domains[2:]),
+                         sorted(list(addresses.values()) + ['10.0.0.1']))
+        published = harness.get_relation_data(rel_id, 'nextcloud')['nextcloud_config']
+        self.assertIn(addresses[sorted(addresses)[0]], published)
+
+    def test_peer_order_is_not_a_change(self):
+        harness = self._harness(leader=True)
+        harness.charm._mark_applied('chunk_size', harness.charm.config['chunked-upload-max-size'])
+        rel_id = harness.add_relation('cluster', 'nextcloud')
+        for n in range(1, 4):
+            unit = 'nextcloud/{}'.format(n)
+            harness.add_relation_unit(rel_id, unit)
+            harness.update_relation_data(rel_id, unit, {'ingress-address': '10.0.0.{}'.format(n)})
+        relation = harness.model.get_relation('cluster')
+        units = sorted(relation.units, key=lambda u: u.name)
+        for order in [units, units[::-1]]:
+            relation.units = order
+            self.assertEqual(self._hook(harness.charm.on.update_status.emit), 0)
+
+    def test_followers_converge(self):
+        harness = self._harness(leader=False)
+        rel_id = harness.add_relation('cluster', 'nextcloud')
+        harness.add_relation_unit(rel_id, 'nextcloud/1')
+        config_php = Path(self.root.name, 'config', 'config.php')
+        for version in range(3):
+            published = "<?php $CONFIG = array('version' => {});".format(version)
+            harness.update_relation_data(rel_id, 'nextcloud', {'nextcloud_config': published})
+            self.assertEqual(config_php.read_text(), published)
+        self.assertTrue(Path(self.root.name, 'data', '.ocdata').exists())
+        self.assertTrue(harness.charm._stored.nextcloud_initialized)
+        self.assertEqual(self.occ_calls, [])
+
+
+class TestPaths(ReconcileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.old_root = os.path.join(self.tmp.name, 'www', 'nextcloud')
+        os.makedirs(os.path.join(self.old_root, 'config'))
+        os.makedirs(os.path.join(self.old_root, 'data', 'admin'))
+        Path(self.old_root, 'config', 'config.php').write_text("<?php")
+        self.harness = Harness(NextcloudCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.update_config({'nextcloud-root': self.old_root})
+        self.harness.begin()
+        self.harness.charm._stored.nextcloud_root = self.old_root
+        self.harness.charm._stored.data_dir = os.path.join(self.old_root, 'data')
+        self.harness.charm._stored.nextcloud_fetched = True
+
+    def test_defaults(self):
+        paths = NextcloudPaths()
+        self.assertEqual(paths.config_php, '/var/www/nextcloud/config/config.php')
+        self.assertEqual(paths.data_dir, '/var/www/nextcloud/data')
+        self.assertEqual(paths.overlay('redis'), '/var/www/nextcloud/config/redis.config.php')
+        self.assertIsNone(paths.temp_dir)
+
+    def test_move_root_with_data_inside(self):
+        new_root = os.path.join(self.tmp.name, 'nvme', 'nextcloud')
+        self.harness.update_config({'nextcloud-root': new_root})
+        paths = self.harness.charm.paths
+        self.assertEqual(paths, NextcloudPaths(new_root))
+        self.assertTrue(os.path.exists(paths.config_php))
+        self.assertTrue(os.path.isdir(os.path.join(new_root, 'data', 'admin')))
+        self.assertFalse(os.path.exists(self.old_root))
+
+    def test_move_data_out_of_root(self):
+        data_dir = os.path.join(self.tmp.name, 'data')
+        os.mkdir(data_dir)
+        self.harness.update_config({'data-dir': data_dir})
+        self.assertEqual(self.harness.charm.paths.data_dir, data_dir)
+        self.assertTrue(os.path.isdir(os.path.join(data_dir, 'admin')))
+        self.assertFalse(os.path.exists(os.path.join(self.old_root, 'data')))
+
+    def test_no_move_while_over_memory_budget(self):
+        new_root = os.path.join(self.tmp.name, 'nvme', 'nextcloud')
+        with patch('charm.mem_total_bytes', return_value=1024 ** 3):
+            self.harness.update_config({'nextcloud-root': new_root, 'php_memory_limit': '4G'})
+        self.assertEqual(self.harness.charm.paths.root, self.old_root)
+        self.assertFalse(subprocess.call.called)
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+
+        with patch('charm.mem_total_bytes', return_value=8 * 1024 ** 3):
+            self.harness.update_config({'php_memory_limit': '512M'})
+        self.assertEqual(self.harness.charm.paths.root, new_root)
+        subprocess.check_call.assert_called_with(['systemctl', 'restart', 'apache2.service'])
+
+    def test_adopt_move_of_failed_hook(self):
+        new_root = os.path.join(self.tmp.name, 'nvme', 'nextcloud')
+        self.harness.update_config({'nextcloud-root': new_root})
+        # The hook failed after moving, so the stored paths were not saved.
+        self.harness.charm._stored.nextcloud_root = self.old_root
+        self.harness.charm._stored.data_dir = os.path.join(self.old_root, 'data')
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.paths, NextcloudPaths(new_root))
+        self.assertIsNone(self.harness.charm._stored.path_error)
+        self.assertTrue(os.path.exists(os.path.join(new_root, 'config', 'config.php')))
+
+    def test_create_data_dir_before_install(self):
+        # A fresh install, where the stored paths are the configured ones.
+        data_dir = os.path.join(self.tmp.name, 'srv', 'data')
+        self.harness.charm._stored.nextcloud_fetched = False
+        self.harness.update_config({'data-dir': data_dir})
+        self.harness.charm._stored.data_dir = data_dir
+        self.assertFalse(os.path.exists(data_dir))
+        self.harness.charm._stored.database_available = True
+        with patch('charm.shutil.chown') as chown, \
+                patch.object(NextcloudCharm, '_init_nextcloud',
+                             side_effect=lambda: self.assertTrue(chown.called)) as init, \
+                patch.object(NextcloudCharm, '_add_initial_trusted_domain'), \
+                patch.object(NextcloudCharm, 'get_nextcloud_status',
+                             return_value={'installed': False}):
+            self.harness.charm._reconcile_leader()
+        self.assertTrue(init.called)
+        self.assertTrue(os.path.isdir(data_dir))
+        chown.assert_called_with(data_dir, 'www-data', 'www-data')
+
+    def test_refuse_non_empty_target(self):
+        new_root = os.path.join(self.tmp.name, 'busy')
+        os.makedirs(os.path.join(new_root, 'something'))
+        self.harness.update_config({'nextcloud-root': new_root})
+        self.assertEqual(self.harness.charm.paths.root, self.old_root)
+        self.assertTrue(os.path.exists(os.path.join(self.old_root, 'config', 'config.php')))
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Every hook pays for importing the charm, keep that cost from growing back.
+    """
+    # Import time of src/charm.py on top of ops itself, in microseconds.
+    BUDGET_US = 60000
+    SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+    def _python(self, *args):
+        env = dict(os.environ, PYTHONPATH=self.SRC, JUJU_UNIT_NAME='nextcloud/0',
+                   JUJU_DISPATCH_PATH='hooks/update-status')
+        return subprocess.run([sys.executable] + list(args), env=env, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def _cumulative_us(self, importtime_output, module):
+        for line in importtime_output.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                return int(fields[1])
+        return 0
+
+    def test_update_status_skips_heavy_imports(self):
+        out = self._python('-c', 'import sys, charm; charm.NextcloudCharm; '
+                                 'print(" ".join(sorted(sys.modules)))').stdout.split()
+        for module in ['jinja2', 'pgsql', 'interface_redis', 'requests']:
+            self.assertNotIn(module, out)
+
+    def test_import_time_budget(self):
+        overheads = []
+        for _ in range(3):
+            stderr = self._python('-X', 'importtime', '-c', 'import charm').stderr
+            overhead = self._cumulative_us(stderr, 'charm') - self._cumulative_us(stderr, 'ops')
+            overheads.append(overhead)
+        self.assertLess(min(overheads), self.BUDGET_US)
@@ -20,6 +20,7 @@ class RedistestCharm(CharmBase):
         super().__init__(*args)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.fortune_action, self._on_fortune_action)
+        self.framework.observe(self.on.benchmark_action, self._on_benchmark_action)
 
         self._stored.set_default(redis_info=dict())
         self._redis = RedisClient(self, "redis")
@@ -46,6 +47,34 @@ class RedistestCharm(CharmBase):
             logger.debug("REDIS: {}".format( self._stored.redis_info['redis_hostname']))
             event.set_results({"fortune": "A bug in the code is worth two in the documentation."})
 
+    def _on_benchmark_action(self, event):
+        """
+        Runs GET/SET/lock workloads against the related redis,
+        with and without pipelining, and reports ops/sec and latencies.
+        """
+        info = self._stored.redis_info
+        if not info.get('redis_hostname'):
+            event.fail("No redis relation data available.")
+            return
+        from redis_bench import RedisBenchmark, WORKLOADS
+        workloads = [w.strip() for w in event.params['workloads'].split(',')]
+        unknown = set(workloads) - set(WORKLOADS)
+        if unknown:
+            event.fail("Unknown workloads: {}".format(', '.join(sorted(unknown))))
+            return
+        for param in ['ops', 'concurrency', 'pipeline']:
+            if event.params[param] < 1:
+                event.fail("{} must be at least 1.".format(param))
+                return
+        bench = RedisBenchmark(info['redis_hostname'], info['redis_port'],
+                               password=info.get('redis_password'),
+                               concurrency=event.params['concurrency'],
+                               value_size=event.params['value-size'])
+        results = bench.run(workloads=workloads,
+                            ops=event.params['ops'],
+                            pipeline=event.params['pipeline'])
+        event.set_results(results)
+
     def set_redis_info(self, info: dict):
         self._stored.redis_info = info
 
@@ -0,0 +1,245 @@
+"""Redis load probe: GET/SET/lock workloads over a minimal RESP client."""
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WORKLOADS = ('set', 'get', 'lock')
+
+# Nextcloud's redis locking provider takes a lock with SET NX EX and
+# releases it with DEL, so a lock cycle here is those two commands.
+LOCK_TTL = 3600
+
+
+class RedisError(Exception):
+    """Error reply from redis."""
+
+
+class RespConnection:
+    """
+    A single connection speaking the redis protocol (RESP),
+    just enough for the benchmark.
+    """
+
+    def __init__(self, host, port, password=None, timeout=10):
+        self._sock = socket.create_connection((host, int(port)), timeout=timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(out)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by redis")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RedisError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError("unexpected reply {!r}".format(line))
+
+    def execute(self, *args):
+        self._sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    def pipeline(self, commands) -> list:
+        """
+        Send all commands in one write and read back the replies.
+        """
+        self._sock.sendall(b''.join(self._encode(args) for args in commands))
+        replies = []
+        for _ in commands:
+            try:
+                replies.append(self._read_reply())
+            except RedisError as e:
+                replies.append(e)
+        return replies
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of samples, None when there are none.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(ops, errors, latencies, elapsed) -> dict:
+    """
+    ops and errors count commands (or lock cycles), latencies are
+    seconds per round trip, i.e. per batch when pipelining.
+    """
+    summary = {
+        'ops': ops,
+        'errors': errors,
+        'ops-per-sec': round((ops - errors) / elapsed, 2) if elapsed else 0.0,
+    }
+    if latencies:
+        for pct in (50, 95, 99):
+            summary['p{}-ms'.format(pct)] = round(percentile(latencies, pct) * 1000, 3)
+    return summary
+
+
+def _commands(workload, key, value):
+    if workload == 'set':
+        return [('SET', key, value)]
+    if workload == 'get':
+        return [('GET', key)]
+    if workload == 'lock':
+        return [('SET', key, '-1', 'NX', 'EX', LOCK_TTL), ('DEL', key)]
+    raise ValueError("unknown workload {}".format(workload))
+
+
+def _failed(workload, replies) -> bool:
+    if any(isinstance(reply, Exception) for reply in replies):
+        return True
+    # A lock that could not be acquired is a failed cycle.
+    return workload == 'lock' and replies[0] is None
+
+
+class RedisBenchmark:
+    """
+    Runs workloads against a redis server from a number of
+    concurrent connections, each doing its share of the operations.
+    """
+
+    def __init__(self, host, port, password=None, concurrency=4, value_size=100):
+        self._host = host
+        self._port = port
+        self._password = password
+        self._concurrency = concurrency
+        self._value = os.urandom(value_size)
+        self._prefix = 'redistest-{}'.format(os.getpid())
+
+    def _connect(self):
+        return RespConnection(self._host, self._port, self._password)
+
+    def _worker(self, worker, workload, count, pipeline, outcome, lock):
+        # get reads back what set wrote, locks use their own keys.
+        space = 'lock' if workload == 'lock' else 'kv'
+        latencies, errors, done = [], 0, 0
+        try:
+            conn = self._connect()
+        except OSError as e:
+            logger.error("Could not connect to redis: %s", e)
+            conn = None
+        try:
+            batch = max(1, pipeline)
+            for start in range(0, count if conn else 0, batch):
+                keys = ['{}:{}:{}:{}'.format(self._prefix, space, worker, i)
+                        for i in range(start, min(start + batch, count))]
+                per_key = [_commands(workload, key, self._value) for key in keys]
+                began = time.monotonic()
+                if pipeline > 1:
+                    replies = conn.pipeline([c for cmds in per_key for c in cmds])
+                else:
+                    replies = []
+                    for cmds in per_key:
+                        for c in cmds:
+                            try:
+                                replies.append(conn.execute(*c))
+                            except RedisError as e:
+                                replies.append(e)
+                latencies.append(time.monotonic() - began)
+                step = len(per_key[0])
+                errors += sum(_failed(workload, replies[i:i + step])
+                              for i in range(0, len(replies), step))
+                done += len(keys)
+        except OSError as e:
+            logger.error("Lost connection to redis: %s", e)
+        finally:
+            if conn:
+                conn.close()
+        with lock:
+            outcome['latencies'].extend(latencies)
+            # Whatever was not done because of connection errors failed.
+            outcome['errors'] += errors + count - done
+
+    def run_workload(self, workload, ops, pipeline=1) -> dict:
+        outcome = {'latencies': [], 'errors': 0}
+        lock = threading.Lock()
+        shares = [ops // self._concurrency + (1 if i < ops % self._concurrency else 0)
+                  for i in range(self._concurrency)]
+        threads = [threading.Thread(target=self._worker,
+                                    args=(i, workload, share, pipeline, outcome, lock))
+                   for i, share in enumerate(shares) if share]
+        began = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - began
+        return summarize(ops, outcome['errors'], outcome['latencies'], elapsed)
+
+    def cleanup(self):
+        """
+        Remove the keys written by the workloads. SCAN rather than
+        KEYS, so a shared redis is not blocked while we look for them.
+        """
+        try:
+            conn = self._connect()
+        except OSError as e:
+            logger.error("Could not connect to redis for cleanup: %s", e)
+            return
+        try:
+            cursor = b'0'
+            while True:
+                cursor, keys = conn.execute('SCAN', cursor, 'MATCH',
+                                            '{}:*'.format(self._prefix), 'COUNT', 1000)
+                if keys:
+                    conn.execute('DEL', *keys)
+                if cursor == b'0':
+                    break
+        finally:
+            conn.close()
+
+    def run(self, workloads=WORKLOADS, ops=10000, pipeline=16) -> dict:
+        """
+        Run each workload without and, if pipeline > 1, with pipelining.
+        get reads the keys set writes, so without a set run before it
+        they are written first, unreported.
+        """
+        results = {}
+        try:
+            for workload in workloads:
+                if workload == 'get' and 'set' not in results:
+                    self.run_workload('set', ops)
+                results[workload] = self.run_workload(workload, ops)
+                if pipeline > 1:
+                    results[workload + '-pipelined'] = self.run_workload(
+                        workload, ops, pipeline)
+        finally:
+            self.cleanup()
+        return results
@@ -1,11 +1,14 @@
 # Copyright 2020 Erik Lönroth
 # See LICENSE file for licensing details.
 
+import socketserver
+import threading
 import unittest
 from unittest.mock import Mock
 
 from ops.testing import Harness
 from charm import RedistestCharm
+from redis_bench import RedisBenchmark, percentile
 
 
 class TestCharm(unittest.TestCase):
@@ -33,3 +36,128 @@ class TestCharm(unittest.TestCase):
         harness.charm._on_fortune_action(action_event)
 
         self.assertEqual(action_event.fail.call_args, [("fail this",)])
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    A stand-in for redis-server, speaking enough RESP for the benchmark.
+    """
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            with self.server.lock:
+                if cmd == b'SET':
+                    if b'NX' in args[3:] and args[1] in data:
+                        reply = self._bulk(None)
+                    else:
+                        data[args[1]] = args[2]
+                        reply = b'+OK\r\n'
+                elif cmd == b'GET':
+                    self.server.misses += args[1] not in data
+                    reply = self._bulk(data.get(args[1]))
+                elif cmd == b'DEL':
+                    reply = b':%d\r\n' % sum(data.pop(k, None) is not None for k in args[1:])
+                elif cmd == b'SCAN':
+                    prefix = args[3].rstrip(b'*')
+                    keys = [k for k in data if k.startswith(prefix)]
+                    reply = b'*2\r\n' + self._bulk(b'0') + b'*%d\r\n' % len(keys) + \
+                        b''.join(self._bulk(k) for k in keys)
+                else:
+                    reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+class TestRedisBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeRedisHandler)
+        self.server.daemon_threads = True
+        self.server.data = {}
+        self.server.misses = 0
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_percentile(self):
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        self.assertIsNone(percentile([], 50))
+
+    def test_benchmark_action(self):
+        harness = Harness(RedistestCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm.set_redis_info({'redis_hostname': '127.0.0.1',
+                                      'redis_port': str(self.server.server_address[1]),
+                                      'redis_password': None})
+        action_event = Mock(params={'workloads': 'set,get,lock', 'ops': 200,
+                                    'concurrency': 3, 'pipeline': 8, 'value-size': 32})
+        harness.charm._on_benchmark_action(action_event)
+
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(sorted(results), ['get', 'get-pipelined', 'lock', 'lock-pipelined',
+                                           'set', 'set-pipelined'])
+        for summary in results.values():
+            self.assertEqual(summary['ops'], 200)
+            self.assertEqual(summary['errors'], 0)
+            self.assertGreater(summary['ops-per-sec'], 0)
+            self.assertLessEqual(summary['p50-ms'], summary['p99-ms'])
+        # Everything written is cleaned up afterwards.
+        self.assertEqual(self.server.data, {})
+
+    def test_get_alone_reads_written_keys(self):
+        bench = RedisBenchmark('127.0.0.1', self.server.server_address[1], concurrency=3)
+        results = bench.run(workloads=['get'], ops=100, pipeline=8)
+        self.assertEqual(sorted(results), ['get', 'get-pipelined'])
+        self.assertEqual(self.server.misses, 0)
+        self.assertEqual(self.server.data, {})
+
+    def test_benchmark_action_rejects_bad_params(self):
+        harness = Harness(RedistestCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm.set_redis_info({'redis_hostname': '127.0.0.1', 'redis_port': '6379'})
+        for param in ['ops', 'concurrency', 'pipeline']:
+            params = {'workloads': 'set', 'ops': 10, 'concurrency': 1, 'pipeline': 1,
+                      'value-size': 32}
+            params[param] = 0
+            action_event = Mock(params=params)
+            harness.charm._on_benchmark_action(action_event)
+            action_event.fail.assert_called_once_with("{} must be at least 1.".format(param))
+            self.assertFalse(action_event.set_results.called)
+
+    def test_benchmark_action_without_redis(self):
+        harness = Harness(RedistestCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        action_event = Mock(params={})
+        harness.charm._on_benchmark_action(action_event)
+        self.assertTrue(action_event.fail.called)
+
+    def test_unreachable_redis_counts_errors(self):
+        port = self.server.server_address[1]
+        self.server.shutdown()
+        self.server.server_close()
+        bench = RedisBenchmark('127.0.0.1', port, concurrency=2)
+        summary = bench.run_workload('set', 10)
+        self.assertEqual(summary['errors'], 10)